@@ -1,12 +1,22 @@
 import streamlit as st
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
 import requests
 import pandas as pd
 from pandas.io.json import json_normalize
-import base64
 from crim_intervals import *
+from corpus_loading import load_corpus
+from exports import EXPORT_FORMATS, export_bytes, export_file_name
+from instrumentation import RunTimings
+from interval_index import IntervalIndex
+from jobs import SEARCH_BUDGET, JobManager, JobPending, classify_job, close_matches_job, sweep_job
+from memory_cache import INTERVAL_BYTES, CacheOwner, CacheView, LRUCache
+from pipeline import DURATION_CHOICES, SCALE_CHOICES, IntervalPrecomputer, classified_matches_to_pandas, covers, duration_filter, filter_close_matches, filter_close_results, filter_matches, filter_results, scale_intervals, stage_key
+from profiling import PROFILE, SearchProfile
+from table_view import PAGE_SIZES, TableView
 import ast
-from itertools import tee, combinations
 from typing import List
 # import matplotlib
 
@@ -14,116 +24,59 @@ from typing import List
 
 
 
+# wall time, CPU time and memory of the (disjoint) stages of this run, see instrumentation.py
+timings = RunTimings()
+# the searches of this run under cProfile, if asked for, see profiling.py
+search_profile = SearchProfile(PROFILE or st.experimental_get_query_params().get("profile") == ["1"])
+
 #sets up function to call Markdown File for "about"
 def read_markdown_file(markdown_file):
     return Path(markdown_file).read_text()
 
-# download function for output csv's
+# download function for output files
 
-def download_link(object_to_download, download_filename, download_link_text):
+def download_results(results, file_name, download_text):
     """
-    Generates a link to download the given object_to_download.
-
-    object_to_download (str, pd.DataFrame):  The object to be downloaded.
-    download_filename (str): filename and extension of file. e.g. mydata.csv, some_txt_output.txt
-    download_link_text (str): Text to display for download link.
-
-    Examples:
-    download_link(YOUR_DF, 'YOUR_DF.csv', 'Click here to download data!')
-    download_link(YOUR_STRING, 'YOUR_STRING.txt', 'Click here to download your text!')
+    Offers results as a file download, in a format chosen next to the button.
 
+    The file is made once per table and format shown in the session, as
+    st.download_button needs it on every rerun.
     """
-    if isinstance(object_to_download,pd.DataFrame):
-        object_to_download = object_to_download.to_csv(index=False)
-
-    # some strings <-> bytes conversions necessary here
-    b64 = base64.b64encode(object_to_download.encode()).decode()
-
-    return f'<a href="data:file/txt;base64,{b64}" download="{download_filename}">{download_link_text}</a>'
-
-# functions for pairs of ratios
-
-def pairwise(iterable):
-    "s -> (s0,s1), (s1,s2), (s2, s3), ..."
-    a, b = tee(iterable)
-    next(b, None)
-    return zip(a, b)
-
-def get_ratios(input_list):
-    ratio_pairs = []
-    for a, b in pairwise(input_list):
-        ratio_pairs.append(b / a)
-    return ratio_pairs
+    export_format = st.radio('File format', list(EXPORT_FORMATS))
+    exported = st.session_state.get("exported")
+    if exported is None or exported[0] is not results or exported[1] != export_format:
+        with timings.stage('export'):
+            exported = (results, export_format, export_bytes(results, export_format))
+        st.session_state.exported = exported
+    st.download_button(download_text, exported[2], file_name=export_file_name(file_name, export_format), mime=EXPORT_FORMATS[export_format][1])
 
-# Here we group the rows in the DF by the Pattern Generating Match
-# Each has its own string of durations, and duration ratios
-# and then we compare the ratios to get the differences
-# the "list(combinations)" method takes care of building the pairs, using data from our dataframe 'results'
+# paged display of result tables
 
-def compare_ratios(ratios_1, ratios_2):
-    
-    ## division of lists 
-    # using zip() + list comprehension 
-    diffs = [i - j for i, j in zip(ratios_1, ratios_2)] 
-    abs_diffs = [abs(ele) for ele in diffs] 
-    sum_diffs = sum(abs_diffs)
-
-    return sum_diffs
+def show_table(df, key):
+    """
+    Shows one page of a table, sorted and filtered on the server, so that
+    only that page is sent to the browser.
 
-#results["Pattern_Generating_Match"] = results["Pattern_Generating_Match"].apply(tuple) 
+    key (str): tells apart the controls of the tables shown in one run
+    """
+    if len(df.columns) == 0:
+        st.write(df)
+        return
+    sort_column, filter_column, page_column = st.columns(3)
+    sort_by = sort_column.selectbox('Sort by', ['(as found)'] + list(df.columns), key=key + '_sort_by')
+    ascending = sort_column.checkbox('Ascending', value=True, key=key + '_ascending')
+    filter_on = filter_column.selectbox('Filter on', ['(any column)'] + list(df.columns), key=key + '_filter_on')
+    filter_text = filter_column.text_input('Containing', key=key + '_filter_text')
+    page_size = page_column.selectbox('Rows per page', PAGE_SIZES, key=key + '_page_size')
+    page = page_column.number_input('Page', min_value=1, value=1, step=1, key=key + '_page')
+    view = TableView(
+        df, page, page_size,
+        sort_by=None if sort_by == '(as found)' else sort_by, ascending=ascending,
+        filter_text=filter_text, filter_column=None if filter_on == '(any column)' else filter_on,
+    )
+    st.write(view.summary() + ", page {} of {}".format(view.page, view.pages))
+    st.write(view.rows)
 
-def get_ratio_distances(results, pattern_col, output_cols):
-    
-    matches = []
-
-    for name, group in results.groupby(pattern_col):
-
-        ratio_pairs = list(combinations(group.index.values, 2))
-
-        for a, b in ratio_pairs:
-            
-            a_match = results.loc[a]
-            b_match = results.loc[b]
-            
-            sum_diffs = compare_ratios(a_match.duration_ratios, b_match.duration_ratios)
-            
-            match_dict = {
-                "pattern": name,
-                "sum_diffs": sum_diffs
-            }
-            
-            for col in output_cols:
-                match_dict.update({
-                    f"match_1_{col}": a_match[col],
-                    f"match_2_{col}": b_match[col]
-                })
-                
-            matches.append(match_dict)
-            
-    return pd.DataFrame(matches)
-
-
-# classifier output to pandas
-
-
-def classified_matches_to_pandas(matches):
-    
-    soggetti_matches = []
-    
-    for i, cm in enumerate(matches):
-        
-        for j, soggetti in enumerate(cm.matches):
-            
-            soggetti_matches.append({
-                "piece": soggetti.first_note.metadata.title,
-                "type": cm.type,
-                "part": soggetti.first_note.part.strip("[] "),
-                "start_measure": soggetti.first_note.note.measureNumber,
-                "entry_number": j + 1,
-                "pattern": cm.pattern,
-                "match_number": i + 1
-            })
-    return pd.DataFrame(soggetti_matches)
 # work lists
 
 WorkList_mei = ['CRIM_Mass_0001_1.mei',
@@ -274,64 +227,63 @@ cwd = str(Path.cwd())
 WorkList_mei = [el.replace("CRIM_", cwd+"/mei/CRIM_") for el in selected_works]
 
 @st.cache(allow_output_mutation=True)
+def memory_cache():
+    # one LRU cache, bounded by $CRIM_CACHE_MAX_BYTES, shared by all sessions
+    return LRUCache()
+
+def cache_owner():
+    # the session, for pinning the pieces of its selection in the memory cache;
+    # the pins go with the session state when the session ends
+    if "cache_owner" not in st.session_state:
+        st.session_state.cache_owner = CacheOwner()
+    return st.session_state.cache_owner
+
+def session_id():
+    # the keys of its jobs and of its results in the memory cache start with
+    # it, so that sessions never share (or cancel) a job or a result
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+@st.cache(allow_output_mutation=True)
+def interval_precomputer():
+    # one background thread, shared by all sessions, computing the interval
+    # bases of the duration modes not chosen yet
+    return IntervalPrecomputer(memory_cache())
+
 def load_corpusbase(WorkList_mei:List):
-    corpus = CorpusBase(WorkList_mei)
+    # the corpus is assembled from single-piece corpora in the memory cache, so
+    # changing the selection only loads the pieces that were added to it.
+    # Titles are read from the MEI headers when a piece is parsed.
+    # Parsed pieces are kept on disk too, so restarts don't re-parse the MEI;
+    # pieces missing from that cache are parsed in parallel ($CRIM_LOAD_WORKERS processes).
+    # The pieces of the selection are pinned, so that a selection larger than
+    # the cache is not evicted while it loads and loaded again on every rerun
+    corpus = load_corpus(WorkList_mei, cache=memory_cache(), owner=cache_owner())
     return corpus
 
 # Now pass the list of MEI files to Crim intervals
 #@st.cache(allow_output_mutation=True)
 #if st.sidebar.button('Load Selections'):
-corpus = load_corpusbase(WorkList_mei)
-
-# Correct the MEI metadata
-
-import xml.etree.ElementTree as ET
-import requests
-
-MEINSURI = 'http://www.music-encoding.org/ns/mei'
-MEINS = '{%s}' % MEINSURI
-
-for i, path in enumerate(WorkList_mei):
-    
-    try:
-        if path[0] == '/':
-            mei_doc = ET.parse(path)
-        else:
-            mei_doc = ET.fromstring(requests.get(path).text)
-
-      # Find the title from the MEI file and update the Music21 Score metadata
-        title = mei_doc.find('mei:meiHead//mei:titleStmt/mei:title', namespaces={"mei": MEINSURI}).text
-        print(path, title)
-        corpus.scores[i].metadata.title = title
-    except:
-        continue
+with timings.stage('load'):
+    corpus = load_corpusbase(WorkList_mei)
 
 # Header
 
 # Select Actual or Incremental Durations
 st.sidebar.subheader("Step 2:  Select Rhythmic Preference")
-duration_choice = st.sidebar.radio('Select Actual or Incremental Durations', ["Actual","Incremental@1","Incremental@2", "Incremental@4"])
-
-if duration_choice == 'Actual':
-    vectors = IntervalBase(corpus.note_list)
-elif duration_choice == 'Incremental@1':
-    vectors = IntervalBase(corpus.note_list_incremental_offset(1))
-elif duration_choice == 'Incremental@2':
-    vectors = IntervalBase(corpus.note_list_incremental_offset(2))
-elif duration_choice == 'Incremental@4':
-    vectors = IntervalBase(corpus.note_list_incremental_offset(4))
-else:
-    st.write("Please select duration preference")
+duration_choice = st.sidebar.radio('Select Actual or Incremental Durations', DURATION_CHOICES)
+
+# interval bases are cached per corpus and duration, with both scales computed;
+# the other durations are computed in the background meanwhile
+with timings.stage('intervals'):
+    vectors = interval_precomputer().interval_base(corpus, duration_choice)
+
 # Select Generic or Semitone
 st.sidebar.subheader("Step 3:  Select Interval Preference")
-scale_choice = st.sidebar.radio('Select Diatonic or Chromatic', ["Diatonic","Chromatic"])
+scale_choice = st.sidebar.radio('Select Diatonic or Chromatic', SCALE_CHOICES)
 
-if scale_choice == 'Diatonic':
-    scale = vectors.generic_intervals
-elif scale_choice == 'Chromatic':
-    scale = vectors.semitone_intervals
-else:
-    st.write("Please select duration preference")
+scale = scale_intervals(vectors, scale_choice)
 
 # Select Vector Length and Minimum Number of Matches
 st.sidebar.subheader("Step 4:  Select Vectors, Matches, and Thresholds")
@@ -344,7 +296,108 @@ close_distance = st.sidebar.number_input("If Close Search, then Enter Threshold,
 
 max_sum_diffs = st.sidebar.number_input("Enter Maximum Durational Differences (Whole Number or Fractional Value), or use default", min_value=None, max_value=None, value=2)
 
-patterns = into_patterns([scale], vector_length)
+@st.cache(allow_output_mutation=True)
+def interval_index():
+    # the offline index of interval n-grams, built with `python interval_index.py`
+    return IntervalIndex()
+
+# the sidebar parameters; pipeline.STAGE_PARAMETERS lists the stages each of
+# them feeds, and only those stages are run again when it changes
+params = {"selection": tuple(selected_works), "duration": duration_choice, "scale": scale_choice, "vector_length": vector_length,
+          "minimum_match": minimum_match, "close_distance": close_distance, "max_sum_diffs": max_sum_diffs}
+
+def stored_patterns():
+    key = stage_key('patterns', params)
+    patterns = search_store().get(key)
+    if patterns is None:
+        with timings.stage('patterns'):
+            patterns = into_patterns([scale], vector_length)
+        search_store().put(key, patterns, INTERVAL_BYTES * len(patterns))
+    return patterns
+
+def widest(stage, thresholds, compute, prefix=()):
+    # (bounds, result) of stage for thresholds at least as wide as those asked
+    # for, see pipeline.MONOTONE_THRESHOLDS; computed again, by
+    # compute(**thresholds), only when thresholds are wider than the bounds
+    # stored.  It is computed at thresholds, not at thresholds merged with the
+    # bounds: (1, 5) merged from (10, 5) and (1, 2) would be a wider and slower
+    # search than either.  The result is to be filtered down to thresholds
+    key = ('widest',) + prefix + stage_key(stage, dict(params, **dict.fromkeys(thresholds)))
+    stored = search_store().get(key)
+    if stored is None and key in partial_store():
+        # a partial result the pending search goes on from, with its notes
+        stored, notes = partial_store()[key]
+        if covers(stored[0], thresholds):
+            search_notes.extend(notes)
+            return stored
+    if stored is None or not covers(stored[0], thresholds):
+        bounds = dict(thresholds)
+        noted = len(search_notes)
+        stored = (bounds, compute(**bounds))
+        if len(search_notes) > noted:
+            partial_store()[key] = (stored, search_notes[noted:])
+        keep_search(key, stored)
+    return stored
+
+def search_matches(kind, minimum_match, close_distance=None):
+    patterns = stored_patterns()
+    if kind == 'exact':
+        with timings.stage('matching'), interval_precomputer().searching():
+            return find_exact_matches(patterns, minimum_match)
+    # timed in the job
+    return background(('close_matches',) + stage_key('patterns', params) + (minimum_match, close_distance),
+                      'Close search', 'patterns', close_matches_job, patterns, minimum_match, close_distance,
+                      context=interval_precomputer().searching)
+
+def match_thresholds(kind):
+    if kind == 'exact':
+        return {"minimum_match": minimum_match}
+    return {"minimum_match": minimum_match, "close_distance": close_distance}
+
+def stored_matches(kind, thresholds=None):
+    # the PatternMatches of an exact or close search, shared by Steps 5 and 6
+    # and the classifier, and filtered from the widest search stored.
+    # classify_matches sorts the matches of each pattern in place, so give it
+    # copied_matches()
+    thresholds = thresholds or match_thresholds(kind)
+    _, matches = widest(kind + '_matches', thresholds, lambda **bounds: search_matches(kind, **bounds))
+    if kind == 'exact':
+        return filter_matches(matches, thresholds["minimum_match"])
+    return filter_close_matches(matches, thresholds["close_distance"], thresholds["minimum_match"])
+
+def copied_matches(matches):
+    return [PatternMatches(pattern_matches.pattern, list(pattern_matches.matches)) for pattern_matches in matches]
+
+def search_results(kind, **thresholds):
+    # exact matches are looked up in the interval index when it covers every
+    # selected piece
+    results = None
+    if kind == 'exact':
+        with timings.stage('matching (index)'):
+            results = interval_index().exact_matches(WorkList_mei, duration_choice, scale_choice, vector_length, thresholds["minimum_match"])
+    if results is None:
+        matches = stored_matches(kind, thresholds)
+        with timings.stage('export_pandas'), interval_precomputer().searching():
+            results = pd.DataFrame(export_pandas(matches))
+    return results
+
+def stored_results(kind):
+    # export_pandas of stored_matches(kind), filtered from the widest search
+    # stored.  Step 6 adds a column to its results, so it works on a copy
+    _, results = widest(kind + '_matches', match_thresholds(kind), lambda **bounds: search_results(kind, **bounds), prefix=('results',))
+    if kind == 'exact':
+        return filter_results(results, minimum_match)
+    return filter_close_results(results, close_distance, minimum_match)
+
+def stored_durations(kind):
+    # the results with their 'duration ratios', and the pairs of them within
+    # max_sum_diffs, filtered from the widest max_sum_diffs stored
+    def compute(max_sum_diffs):
+        results = stored_results(kind).copy()
+        with timings.stage('ratio distances'):
+            return results, duration_filter(results, max_sum_diffs)
+    _, (results, ratios_filtered) = widest(kind + '_durations', {"max_sum_diffs": max_sum_diffs}, compute)
+    return results, ratios_filtered[ratios_filtered["sum_diffs"] <= max_sum_diffs]
 
 search_summary_key = "Key:  VE = Number of Melodic Vectors, MM = Minimum Matches, CD = Melodic Close Distance, DD = Maximum Sum of Durational Differences"
 close_short_search_summary = "{}_{}_V{}_M{}_C{}".format(duration_choice, scale_choice, vector_length, minimum_match, close_distance)
@@ -353,123 +406,238 @@ close_dur_short_search_summary = "{}_{}_V{}_M{}_C{}_D{}".format(duration_choice,
 exact_dur_short_search_summary = "{}_{}_V{}_M{}_D{}".format(duration_choice, scale_choice, vector_length, minimum_match, max_sum_diffs)
 
 
+# Search results are kept in the session under the button and parameters that
+# produced them, and shown from there until another search runs, so that the
+# widgets shown with them (filenames for downloads) don't search again.
+
+def search_store():
+    # the results of this session, kept in the memory cache so that they count
+    # towards its budget however many sessions there are, and are evicted
+    # least recently used first along with everything else
+    return CacheView(memory_cache(), (session_id(),))
+
+def show_search(key, results):
+    # the search shown keeps its results even if the store evicts them, along
+    # with the notes on them (None while the search waits for a job).  They
+    # stay in the store, pinned for the session, so that the memory cache
+    # still counts them; partial results under a key of their own, as they
+    # are not to be found by the search again
+    if results is not None:
+        st.session_state.shown_search = (key, results, " ".join(search_notes))
+        if search_notes:
+            key = ('shown_search',)
+        search_store().put(key, results)
+        memory_cache().pin(cache_owner(), [search_store().prefix + key], group='shown')
+
+def shown_search(button):
+    # summary and results of the search shown, if it was run with this button
+    shown = st.session_state.get("shown_search")
+    if shown is None or shown[0][0] != button:
+        return None
+    key, results, notes = shown
+    if notes:
+        st.warning(notes)
+    return key[2], results
+
+def keep_search(key, results):
+    # stores the results of a search, unless they are partial
+    if not search_notes:
+        search_store().put(key, results)
+
+def partial_store():
+    # partial results of the stages of the pending search, e.g. of a close
+    # search stopped by its budget before the classifier's job runs on it,
+    # kept until the search finishes rather than searched for again on the
+    # next poll (and stopped again)
+    if "partial_store" not in st.session_state:
+        st.session_state.partial_store = {}
+    return st.session_state.partial_store
+
+
+# Close searches, classifications and parameter comparisons run as background
+# jobs (see jobs.py), which the script polls for, showing their progress,
+# until they finish.
+
+@st.cache(allow_output_mutation=True)
+def job_manager():
+    # worker threads running the long searches of all sessions
+    return JobManager()
+
+POLL_SECONDS = 1
+
+# notes on the results of this run, e.g. that they are partial
+search_notes = []
+# whether a search of this run waits for a job
+polling = False
+# key of the search this run finished, if any
+searched = None
+# keys of the jobs this run asked for
+asked_jobs = set()
+
+def background(key, description, unit, function, *args, context=None):
+    # the result of function(job, *args), run as a job under key in the with
+    # block of context() if given; raises JobPending until the job has
+    # finished.  The job's stages and profile are added to those of the run
+    # that takes its result
+    key = (session_id(),) + key
+    asked_jobs.add(key)
+    job = job_manager().submit(key, description, unit, function, *args, budget=search_budget or None, profile=search_profile.enabled, context=context)
+    if not job.finished():
+        raise JobPending(job)
+    job_manager().pop(key)
+    timings.stages += job.timings.stages
+    search_profile.add(job.profile)
+    if job.error is not None:
+        raise job.error
+    if job.partial:
+        search_notes.append(job.partial_note())
+    return job.result
+
+def pending_search(key):
+    # whether the search under key waits for a job
+    return st.session_state.get("pending_search") == key
+
+@contextmanager
+def background_search(key):
+    # runs the search under key again on every poll while a job it waits for
+    # runs, showing the job's progress meanwhile.  What the polls before
+    # profiled is carried over to the run that finishes the search
+    global polling, searched
+    stashed = st.session_state.pop("pending_profile", None)
+    if stashed is not None and stashed[0] == key:
+        search_profile.add(stashed[1])
+    try:
+        yield
+    except JobPending as pending:
+        st.session_state.pending_search = key
+        polling = True
+        if search_profile.captured:
+            st.session_state.pending_profile = (key, search_profile)
+        st.write(pending.job.status())
+        st.progress(pending.job.fraction())
+        if st.button('Cancel search', key='cancel_search'):
+            pending.job.cancel()
+    else:
+        searched = key
+        if pending_search(key):
+            st.session_state.pending_search = None
+
+search_budget = st.sidebar.number_input("Stop Close Searches, Classifications and Comparisons after this many Seconds, showing Partial Results (0 for no limit)", min_value=0, value=int(SEARCH_BUDGET))
+
 # Select Exact or Close
 
 st.sidebar.subheader("Step 5: Search for Similar Melodies")
 st.sidebar.write("Adjust Time and Melodic Scales, Vectors, Minimum Matches, and Melodic Flex in Steps 2, 3, 4 at left, or use defaults") 
 
-if st.sidebar.button('Run Exact Search'):
-    patterns = into_patterns([scale], vector_length)
-    find_matches = find_exact_matches(patterns, minimum_match)
-    output = export_pandas(find_matches)
-    #pd.DataFrame(output).head()
-    results = pd.DataFrame(output)
-    st.subheader('Key Values for Your Exact Search: ')
-    st.write(exact_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    st.write('Results of Exact Melodic Pattern Search')
-    st.write(results)
-    st.subheader("Optional:  Download CSV of Exact Melodies from Step 5")
-    s1 = st.text_input('Provide filename for melodic pattern match download (must include ".csv")')
-    tmp_download_link = download_link(results, s1, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
-if st.sidebar.button('Run Close Search'):
-    patterns = into_patterns([scale], vector_length)
-    find_matches = find_close_matches(patterns, minimum_match, close_distance)
-    output = export_pandas(find_matches)
-    #pd.DataFrame(output).head()
-    st.subheader('Key Values for Your Close Search: ')
-    st.write(close_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    results = pd.DataFrame(output)
-    st.write('Results of Close Melodic Pattern Search')
-    st.write(results)
-    st.subheader("Optional:  Download CSV of Close Melodies from Step 5")
-    s2 = st.text_input('Provide filename for melodic pattern match download (must include ".csv")')
-    tmp_download_link = download_link(results, s2, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
+exact_search_key = ('Run Exact Search', tuple(selected_works), exact_short_search_summary)
+if st.sidebar.button('Run Exact Search') or pending_search(exact_search_key):
+    stored = search_store().get(exact_search_key)
+    if stored is None:
+        with search_profile.capture(), background_search(exact_search_key):
+            results = stored_results('exact')
+            stored = (results,)
+            keep_search(exact_search_key, stored)
+    show_search(exact_search_key, stored)
+shown = shown_search('Run Exact Search')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (results,) = shown
+        st.subheader('Key Values for Your Exact Search: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write('Results of Exact Melodic Pattern Search')
+        show_table(results, 'results')
+        st.subheader("Optional:  Download CSV of Exact Melodies from Step 5")
+        s1 = st.text_input('Provide filename for melodic pattern match download (defaults to the key values above)')
+        download_results(results, s1 or summary, 'Click here to download your data!')
+
+close_search_key = ('Run Close Search', tuple(selected_works), close_short_search_summary)
+if st.sidebar.button('Run Close Search') or pending_search(close_search_key):
+    stored = search_store().get(close_search_key)
+    if stored is None:
+        with search_profile.capture(), background_search(close_search_key):
+            results = stored_results('close')
+            stored = (results,)
+            keep_search(close_search_key, stored)
+    show_search(close_search_key, stored)
+shown = shown_search('Run Close Search')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (results,) = shown
+        st.subheader('Key Values for Your Close Search: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write('Results of Close Melodic Pattern Search')
+        show_table(results, 'results')
+        st.subheader("Optional:  Download CSV of Close Melodies from Step 5")
+        s2 = st.text_input('Provide filename for melodic pattern match download (defaults to the key values above)')
+        download_results(results, s2 or summary, 'Click here to download your data!')
     
 st.sidebar.subheader("Step 6: Search with Duration Filter")
 st.sidebar.write("Threshold of Differences between Durational Ratios, or use default, above") 
 
-if st.sidebar.button('Run Exact Search with Duration Filter'):
-    patterns = into_patterns([scale], vector_length)
-    find_matches = find_exact_matches(patterns, minimum_match)
-
-    output = export_pandas(find_matches)
-    results = pd.DataFrame(output)
-    st.subheader('Key Values for Your Exact Search with Durational Distance: ')
-    st.write(exact_dur_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    st.write('Results of Exact Melodic Pattern Search:  Durational Ratios Unfiltered')
-    
-    # clean-up results of melodic match:  chance patterns to tuples 
-    results["pattern_generating_match"] = results["pattern_generating_match"].apply(tuple)
-
-    # evaluation Note_Durations as literals--only needed if we're importing CSV
-
-    #results['note_durations'] = results['note_durations'].apply(ast.literal_eval)
-    
-    durations = results['note_durations']
-    
-    # calculates 'duration ratios' for each soggetto, then adds this to the DF
-
-    results["duration_ratios"] = results.note_durations.apply(get_ratios)
-    
-    st.write(results)
-
-    # now we calculate the _distances_ between pairs of ratios
-
-    ratio_distances = get_ratio_distances(results, "pattern_generating_match", ["piece_title", "part", "start_measure", "end_measure"])
-
-    ratios_filtered = ratio_distances[ratio_distances.sum_diffs <= max_sum_diffs]
-    st.write("Results with Filtered Distances of Durational Ratios")
-    st.write(ratios_filtered)
-
-    st.subheader("Optional:  Download CSV of Exact Melodies and Durations from Step 6")
-    s3 = st.text_input('Provide filename for durational match download (must include ".csv")')
-    tmp_download_link = download_link(ratios_filtered, s3, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
-
-if st.sidebar.button('Run Close Search with Duration Filter'):
-    patterns = into_patterns([scale], vector_length)
-    find_matches = find_close_matches(patterns, minimum_match, close_distance)
-
-    output = export_pandas(find_matches)
-    results = pd.DataFrame(output)
-    st.subheader('Key Values for Your Close Search with Durational Distance: ')
-    st.write(close_dur_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    
-    
-    # clean-up results of melodic match:  chance patterns to tuples 
-    results["pattern_generating_match"] = results["pattern_generating_match"].apply(tuple)
-
-    # evaluation Note_Durations as literals--only needed if we're importing CSV
-
-    #results['note_durations'] = results['note_durations'].apply(ast.literal_eval)
-    
-    durations = results['note_durations']
-    
-    # calculates 'duration ratios' for each soggetto, then adds this to the DF
-
-    results["duration_ratios"] = results.note_durations.apply(get_ratios)
-    st.write("Results of Close Search: Durational Ratios Unfiltered")
-    st.write(results)
-
-    # now we calculate the _distances_ between pairs of ratios
-
-    ratio_distances = get_ratio_distances(results, "pattern_generating_match", ["piece_title", "part", "start_measure", "end_measure"])
-
-    ratios_filtered = ratio_distances[ratio_distances.sum_diffs <= max_sum_diffs]
-    sort_by_measure = ratios_filtered.sort_values(["match_1_start_measure"])
-    st.write("Results with Filtered Distances of Durational Ratios")
-    st.write(sort_by_measure)
-
-    st.subheader("Optional:  Download CSV of Close Melodies and Durations from Step 6")
-    s4 = st.text_input('Provide filename for durational match download (must include ".csv")')
-    tmp_download_link = download_link(sort_by_measure, s4, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
+exact_dur_search_key = ('Run Exact Search with Duration Filter', tuple(selected_works), exact_dur_short_search_summary)
+if st.sidebar.button('Run Exact Search with Duration Filter') or pending_search(exact_dur_search_key):
+    stored = search_store().get(exact_dur_search_key)
+    if stored is None:
+        with search_profile.capture(), background_search(exact_dur_search_key):
+            # evaluation Note_Durations as literals--only needed if we're importing CSV
+
+            #results['note_durations'] = results['note_durations'].apply(ast.literal_eval)
+
+            # the 'duration ratios' of the matches, and the _distances_ between
+            # pairs of ratios, keeping only the pairs within the threshold
+            results, ratios_filtered = stored_durations('exact')
+            stored = (results, ratios_filtered)
+            keep_search(exact_dur_search_key, stored)
+    show_search(exact_dur_search_key, stored)
+shown = shown_search('Run Exact Search with Duration Filter')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (results, ratios_filtered) = shown
+        st.subheader('Key Values for Your Exact Search with Durational Distance: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write('Results of Exact Melodic Pattern Search:  Durational Ratios Unfiltered')
+        show_table(results, 'results')
+        st.write("Results with Filtered Distances of Durational Ratios")
+        show_table(ratios_filtered, 'ratio_distances')
+
+        st.subheader("Optional:  Download CSV of Exact Melodies and Durations from Step 6")
+        s3 = st.text_input('Provide filename for durational match download (defaults to the key values above)')
+        download_results(ratios_filtered, s3 or summary, 'Click here to download your data!')
+
+close_dur_search_key = ('Run Close Search with Duration Filter', tuple(selected_works), close_dur_short_search_summary)
+if st.sidebar.button('Run Close Search with Duration Filter') or pending_search(close_dur_search_key):
+    stored = search_store().get(close_dur_search_key)
+    if stored is None:
+        with search_profile.capture(), background_search(close_dur_search_key):
+            # evaluation Note_Durations as literals--only needed if we're importing CSV
+
+            #results['note_durations'] = results['note_durations'].apply(ast.literal_eval)
+
+            # the 'duration ratios' of the matches, and the _distances_ between
+            # pairs of ratios, keeping only the pairs within the threshold
+            results, ratios_filtered = stored_durations('close')
+            sort_by_measure = ratios_filtered.sort_values(["match_1_start_measure"])
+            stored = (results, sort_by_measure)
+            keep_search(close_dur_search_key, stored)
+    show_search(close_dur_search_key, stored)
+shown = shown_search('Run Close Search with Duration Filter')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (results, sort_by_measure) = shown
+        st.subheader('Key Values for Your Close Search with Durational Distance: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write("Results of Close Search: Durational Ratios Unfiltered")
+        show_table(results, 'results')
+        st.write("Results with Filtered Distances of Durational Ratios")
+        show_table(sort_by_measure, 'ratio_distances')
+
+        st.subheader("Optional:  Download CSV of Close Melodies and Durations from Step 6")
+        s4 = st.text_input('Provide filename for durational match download (defaults to the key values above)')
+        download_results(sort_by_measure, s4 or summary, 'Click here to download your data!')
 
 
 # Classify Presentation Types
@@ -484,43 +652,158 @@ st.sidebar.write()
 max_sum_diffs_classify = st.sidebar.number_input("Enter Maximum Durational Differences Among Soggetti to be Classified (whole number only)", min_value=None, max_value=None, value=1)
 
 
-if st.sidebar.button('Run Classifier with Exact Search'):
-    find_matches = find_exact_matches(patterns, minimum_match)
-    classified_matches = classify_matches(find_matches, max_sum_diffs_classify)
-    classfied_output = classified_matches_to_pandas(classified_matches) 
-    classified_results = pd.DataFrame(classfied_output)
-    st.write()
-    st.subheader('Key Values for Your Exact Search: ')
-    st.write(exact_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    st.write("Presentation Types, Soggetti, and Voices")
-    st.write(classified_results)
-    st.subheader("Optional:  Download CSV of Classified Results")
-    s4 = st.text_input('Provide filename for classified patterns (must include ".csv")')
-    tmp_download_link = download_link(classified_results, s4, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
-    
-if st.sidebar.button('Run Classifier with Close Search'):
-    find_matches = find_close_matches(patterns, minimum_match, close_distance)
-    classified_matches = classify_matches(find_matches, max_sum_diffs_classify)
-    classfied_output = classified_matches_to_pandas(classified_matches) 
-    classified_results = pd.DataFrame(classfied_output)
-    st.write()
-    st.subheader('Key Values for Your Close Search: ')
-    st.write(close_short_search_summary) 
-    st.text("(use this for CSV title or notes)")
-    st.write("Presentation Types, Soggetti, and Voices")
-    st.write(classified_results)
-    st.subheader("Optional:  Download CSV of Classified Results")
-    s4 = st.text_input('Provide filename for classified patterns (must include ".csv")')
-    tmp_download_link = download_link(classified_results, s4, 'Click here to download your data!')
-    st.markdown(tmp_download_link, unsafe_allow_html=True)
-
-
-
-
-        
+exact_classifier_key = ('Run Classifier with Exact Search', tuple(selected_works), exact_short_search_summary, max_sum_diffs_classify)
+if st.sidebar.button('Run Classifier with Exact Search') or pending_search(exact_classifier_key):
+    stored = search_store().get(exact_classifier_key)
+    if stored is None:
+        with search_profile.capture(), background_search(exact_classifier_key):
+            find_matches = copied_matches(stored_matches('exact'))
+            # classify_matches is timed in the job
+            classified_matches = background(stage_key('exact_classified', dict(params, max_sum_diffs_classify=max_sum_diffs_classify)),
+                                            'Classification', 'patterns', classify_job, find_matches, max_sum_diffs_classify,
+                                            context=interval_precomputer().searching)
+            with timings.stage('classify'), interval_precomputer().searching():
+                classfied_output = classified_matches_to_pandas(classified_matches)
+            classified_results = pd.DataFrame(classfied_output)
+            stored = (classified_results,)
+            keep_search(exact_classifier_key, stored)
+    show_search(exact_classifier_key, stored)
+shown = shown_search('Run Classifier with Exact Search')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (classified_results,) = shown
+        st.write()
+        st.subheader('Key Values for Your Exact Search: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write("Presentation Types, Soggetti, and Voices")
+        show_table(classified_results, 'classified_results')
+        st.subheader("Optional:  Download CSV of Classified Results")
+        s4 = st.text_input('Provide filename for classified patterns (defaults to the key values above)')
+        download_results(classified_results, s4 or summary, 'Click here to download your data!')
     
-    
-
-
+close_classifier_key = ('Run Classifier with Close Search', tuple(selected_works), close_short_search_summary, max_sum_diffs_classify)
+if st.sidebar.button('Run Classifier with Close Search') or pending_search(close_classifier_key):
+    stored = search_store().get(close_classifier_key)
+    if stored is None:
+        with search_profile.capture(), background_search(close_classifier_key):
+            find_matches = copied_matches(stored_matches('close'))
+            # classify_matches is timed in the job
+            classified_matches = background(stage_key('close_classified', dict(params, max_sum_diffs_classify=max_sum_diffs_classify)),
+                                            'Classification', 'patterns', classify_job, find_matches, max_sum_diffs_classify,
+                                            context=interval_precomputer().searching)
+            with timings.stage('classify'), interval_precomputer().searching():
+                classfied_output = classified_matches_to_pandas(classified_matches)
+            classified_results = pd.DataFrame(classfied_output)
+            stored = (classified_results,)
+            keep_search(close_classifier_key, stored)
+    show_search(close_classifier_key, stored)
+shown = shown_search('Run Classifier with Close Search')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (classified_results,) = shown
+        st.write()
+        st.subheader('Key Values for Your Close Search: ')
+        st.write(summary) 
+        st.text("(use this for CSV title or notes)")
+        st.write("Presentation Types, Soggetti, and Voices")
+        show_table(classified_results, 'classified_results')
+        st.subheader("Optional:  Download CSV of Classified Results")
+        s4 = st.text_input('Provide filename for classified patterns (defaults to the key values above)')
+        download_results(classified_results, s4 or summary, 'Click here to download your data!')
+
+
+
+# Step 8: numbers of patterns and matches over a grid of parameters, see sweep.py
+
+st.sidebar.subheader("Step 8: Compare Parameters")
+st.sidebar.write("Counts the patterns and matches of the exact and close searches for every combination of the values chosen")
+sweep_durations = st.sidebar.multiselect('Durations to compare', DURATION_CHOICES, default=[duration_choice])
+sweep_scales = st.sidebar.multiselect('Intervals to compare', SCALE_CHOICES, default=[scale_choice])
+sweep_lengths = st.sidebar.slider('Vector lengths to compare', min_value=1, max_value=20, value=(max(1, vector_length - 2), min(20, vector_length + 2)))
+sweep_minimums = st.sidebar.multiselect('Minimum matches to compare', list(range(1, 21)), default=[minimum_match])
+sweep_distances = st.sidebar.multiselect('Close distances to compare', list(range(1, 21)), default=[close_distance])
+sweep_summary = "Compare_{}_{}_V{}-{}_M{}_C{}".format("-".join(sweep_durations), "-".join(sweep_scales), sweep_lengths[0], sweep_lengths[1],
+                                                        "-".join(map(str, sweep_minimums)), "-".join(map(str, sweep_distances)))
+
+sweep_key = ('Run Parameter Comparison', tuple(selected_works), sweep_summary)
+if st.sidebar.button('Run Parameter Comparison') or pending_search(sweep_key):
+    stored = search_store().get(sweep_key)
+    if stored is None:
+        with search_profile.capture(), background_search(sweep_key):
+            # counted over the corpus loaded above, with its interval bases
+            # from the precomputer, rather than loading it again
+            precomputer = interval_precomputer()
+            comparison = background(sweep_key, 'Parameter comparison', 'parameter sets', sweep_job, corpus, sweep_durations, sweep_scales,
+                                    range(sweep_lengths[0], sweep_lengths[1] + 1), sweep_minimums, sweep_distances,
+                                    lambda duration: precomputer.interval_base(corpus, duration))
+            stored = (comparison,)
+            keep_search(sweep_key, stored)
+    show_search(sweep_key, stored)
+shown = shown_search('Run Parameter Comparison')
+if shown is not None:
+    with timings.stage('render'):
+        summary, (comparison,) = shown
+        st.subheader('Key Values for Your Comparison: ')
+        st.write(summary)
+        st.write("Patterns and Matches Found with Each Combination of Parameters, and the Seconds Taken to Find Them")
+        show_table(comparison, 'comparison')
+        st.subheader("Optional:  Download CSV of the Comparison")
+        s5 = st.text_input('Provide filename for the comparison (defaults to the key values above)')
+        download_results(comparison, s5 or summary, 'Click here to download your data!')
+
+
+# Cache statistics
+
+if st.sidebar.checkbox('Show Cache Statistics'):
+    cache_stats = memory_cache().stats()
+    st.sidebar.write("{:.1f} of {:.0f} MB in {} entries, {} pinned".format(cache_stats["size_bytes"] / 1024 ** 2, cache_stats["max_bytes"] / 1024 ** 2, cache_stats["entries"], cache_stats["pinned"]))
+    st.sidebar.write("Hits: {}, Misses: {}, Evictions: {}".format(cache_stats["hits"], cache_stats["misses"], cache_stats["evictions"]))
+    st.sidebar.write("Results of this session: {:.1f} MB".format(search_store().size() / 1024 ** 2))
+
+
+# Stage timings
+
+if st.sidebar.checkbox('Show Stage Timings'):
+    stage_timings = pd.DataFrame(timings.stages)
+    if len(stage_timings):
+        # the resident size after the last run of each stage, the rest summed
+        stage_timings = stage_timings.groupby("stage", sort=False).agg(
+            {"seconds": "sum", "cpu_seconds": "sum", "rss_bytes": "last", "rss_change_bytes": "sum", "peak_allocated_bytes": "max"})
+        stage_timings[["rss_MB", "rss_change_MB", "peak_allocated_MB"]] = stage_timings[["rss_bytes", "rss_change_bytes", "peak_allocated_bytes"]] / 1024 ** 2
+        st.sidebar.write(stage_timings[["seconds", "cpu_seconds", "rss_MB", "rss_change_MB", "peak_allocated_MB"]])
+    st.sidebar.write("Run so far: {:.2f} s".format(timings.total_seconds()))
+
+# Profile of the last search run, when profiling
+
+if search_profile.captured and searched is not None:
+    st.session_state.search_profile = (searched[2], search_profile.prof_bytes(), search_profile.top_functions())
+profiled = st.session_state.get("search_profile")
+if search_profile.enabled and profiled is not None:
+    st.sidebar.subheader("Profile of the Last Search")
+    st.sidebar.download_button('Download profile (.prof)', profiled[1], file_name=profiled[0] + '.prof', mime='application/octet-stream')
+    with st.expander('Most expensive functions of the last search (profile)'):
+        st.text(profiled[2])
+
+# one line per run for the log, with the parameters of the search shown
+shown_key = st.session_state.get("shown_search", ((None,),))[0]
+print(timings.log_line(search=shown_key[0], works=selected_works, duration=duration_choice, scale=scale_choice,
+                       vector_length=vector_length, minimum_match=minimum_match, close_distance=close_distance,
+                       max_sum_diffs=max_sum_diffs, max_sum_diffs_classify=max_sum_diffs_classify), flush=True)
+
+# cancels the jobs of this session that no search waits for any more, e.g.
+# as the parameters changed or another search was started
+for key in st.session_state.get("session_jobs", set()) - asked_jobs:
+    job_manager().discard(key)
+st.session_state.session_jobs = asked_jobs
+
+# polls the job a search waits for
+if polling:
+    time.sleep(POLL_SECONDS)
+    st.experimental_rerun()
+else:
+    st.session_state.pop("partial_store", None)
+    if st.session_state.get("pending_search") is not None:
+        # the parameters changed since the search was started
+        st.session_state.pending_search = None
+        st.session_state.pop("pending_profile", None)
@@ -0,0 +1,233 @@
+"""
+Benchmarks of every stage of the search over the pieces in mei/, without Streamlit.
+
+    python benchmarks.py --sizes 1,5,25,123 --vector-lengths 3,5,8 --output before.json
+    python benchmarks.py --compare before.json after.json
+
+Each stage is timed on its own, for the first N pieces of mei/ (sorted by
+name) for every N in --sizes, and then run again under tracemalloc to
+record its peak memory.  Results are written as JSON, one record per stage
+and parameter set, along with the versions they were measured with, so that
+two runs can be compared with --compare.
+
+Stages:
+    load                        load_corpus (the app's loader, with its disk cache)
+    CorpusBase                  crim_intervals.CorpusBase, parsing every piece
+    intervals                   IntervalBase, per duration mode
+    into_patterns               per duration mode, scale and vector length
+    find_exact_matches
+    exact_index                 the same search through the interval index, if built
+    find_close_matches
+    find_close_matches_indexed
+    get_ratio_distances         of the exact matches, with the durational threshold
+    classify_matches            of the exact matches
+
+find_close_matches compares every distinct pattern with every window, so it
+is only run for sizes up to --slow-max-pieces.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import music21
+import numpy as np
+import pandas as pd
+import crim_intervals
+from crim_intervals import CorpusBase, classify_matches, export_pandas, find_close_matches, find_exact_matches, into_patterns
+
+from close_matches import find_close_matches_indexed
+from corpus_loading import DEFAULT_CACHE_DIR, load_corpus
+from crim_batch import comma_list
+from interval_index import IntervalIndex
+from pipeline import DURATION_CHOICES, SCALE_CHOICES, interval_base, scale_intervals
+from ratio_distances import RaggedArray, get_ratio_distances, get_ratios
+
+STAGES = [
+    "load", "CorpusBase", "intervals", "into_patterns", "find_exact_matches", "exact_index",
+    "find_close_matches", "find_close_matches_indexed", "get_ratio_distances", "classify_matches",
+]
+
+# stages too slow to run on large selections
+SLOW_STAGES = ["CorpusBase", "find_close_matches"]
+
+MEI_DIR = Path(__file__).resolve().parent / "mei"
+
+
+def measure(function, memory=True):
+    """
+    Runs function, returning its result, wall and CPU seconds and, if memory
+    is set, the peak of memory allocated by a second run, in bytes.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, wall, cpu, peak
+
+
+def _size(result):
+    # number of items a stage produced, recorded alongside its timings
+    if hasattr(result, "note_list"):
+        return len(result.note_list)
+    if hasattr(result, "generic_intervals"):
+        return len(result.generic_intervals)
+    if isinstance(result, list) and result and hasattr(result[0], "matches"):
+        return sum(len(pattern_matches.matches) for pattern_matches in result)
+    if result is None:
+        return None
+    return len(result)
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.records = []
+
+    def run(self, stage, params, function):
+        """Measures one stage, unless it is not selected, and returns its result"""
+        if stage not in self.args.stages:
+            return function() if self._needed(stage) else None
+        if stage in SLOW_STAGES and params["pieces"] > self.args.slow_max_pieces:
+            return None
+        result, wall, cpu, peak = measure(function, memory=not self.args.no_memory)
+        record = dict(params, stage=stage, seconds=wall, cpu_seconds=cpu, peak_bytes=peak, output=_size(result))
+        self.records.append(record)
+        print("{:<27} {:8.3f} s {:>9}  {}".format(
+            stage, wall, "" if peak is None else "{:.1f} MB".format(peak / 1024 ** 2),
+            " ".join("{}={}".format(name, value) for name, value in params.items())), flush=True)
+        return result
+
+    def _needed(self, stage):
+        # stages whose results later selected stages are built on
+        later = STAGES[STAGES.index(stage) + 1:]
+        if stage == "load":
+            return True
+        if stage in ("intervals", "into_patterns"):
+            return any(s in self.args.stages for s in later)
+        if stage == "find_exact_matches":
+            return any(s in self.args.stages for s in ("get_ratio_distances", "classify_matches"))
+        return False
+
+    def run_size(self, paths):
+        args = self.args
+        pieces = {"pieces": len(paths)}
+        corpus = self.run("load", pieces, lambda: load_corpus(paths, args.cache_dir, workers=args.workers))
+        self.run("CorpusBase", pieces, lambda: CorpusBase(paths))
+        index = IntervalIndex(args.cache_dir)
+        for duration_choice in args.durations:
+            with_duration = dict(pieces, duration=duration_choice)
+            vectors = self.run("intervals", with_duration, lambda: interval_base(corpus, duration_choice))
+            if vectors is None:
+                continue
+            for scale_choice in args.scales:
+                scale = scale_intervals(vectors, scale_choice)
+                for vector_length in args.vector_lengths:
+                    params = dict(with_duration, scale=scale_choice, vector_length=vector_length)
+                    patterns = self.run("into_patterns", params, lambda: into_patterns([scale], vector_length))
+                    if patterns is None:
+                        continue
+                    search = dict(params, minimum_match=args.minimum_match)
+                    exact = self.run("find_exact_matches", search, lambda: find_exact_matches(patterns, args.minimum_match))
+                    if index.covers(paths, duration_choice):
+                        self.run("exact_index", search, lambda: index.exact_matches(paths, duration_choice, scale_choice, vector_length, args.minimum_match))
+                    close = dict(search, close_distance=args.close_distance)
+                    self.run("find_close_matches", close, lambda: find_close_matches(patterns, args.minimum_match, args.close_distance))
+                    self.run("find_close_matches_indexed", close, lambda: find_close_matches_indexed(patterns, args.minimum_match, args.close_distance))
+                    if exact is None:
+                        continue
+                    results = export_pandas(exact)
+                    if len(results):
+                        ratios = get_ratios(RaggedArray.from_lists(results["note_durations"]))
+                        self.run("get_ratio_distances", dict(search, max_sum_diffs=args.max_sum_diffs), lambda: get_ratio_distances(
+                            results, "pattern_generating_match", ["piece_title", "part", "start_measure", "end_measure"],
+                            max_sum_diffs=args.max_sum_diffs, duration_ratios=ratios))
+                    self.run("classify_matches", dict(search, max_sum_diffs=args.max_sum_diffs_classify), lambda: classify_matches(exact, args.max_sum_diffs_classify))
+
+
+def _versions():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "music21": music21.VERSION_STR,
+        "crim_intervals": getattr(crim_intervals, "__version__", None),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def _record_key(record):
+    return tuple(sorted((name, value) for name, value in record.items() if name not in ("seconds", "cpu_seconds", "peak_bytes", "output")))
+
+
+def compare(before_file, after_file):
+    """Prints the time and peak memory of the stages measured in both files, after over before"""
+    before, after = (json.loads(Path(f).read_text()) for f in (before_file, after_file))
+    before_records = {_record_key(record): record for record in before["results"]}
+    print("{:<27} {:>6} {:>10} {:>10} {:>7} {:>9}".format("stage", "pieces", "before s", "after s", "time", "memory"))
+    for record in after["results"]:
+        old = before_records.get(_record_key(record))
+        if old is None:
+            continue
+        memory = "" if not old["peak_bytes"] or record["peak_bytes"] is None else "{:.2f}x".format(record["peak_bytes"] / old["peak_bytes"])
+        print("{:<27} {:>6} {:>10.3f} {:>10.3f} {:>6.2f}x {:>9}  {}".format(
+            record["stage"], record["pieces"], old["seconds"], record["seconds"], record["seconds"] / max(old["seconds"], 1e-9), memory,
+            " ".join("{}={}".format(name, value) for name, value in _record_key(record) if name not in ("stage", "pieces"))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the search stages over the pieces in mei/.")
+    parser.add_argument("--sizes", type=comma_list(int), default=[1, 5, 25, 123], help="numbers of pieces, comma separated")
+    parser.add_argument("--vector-lengths", type=comma_list(int), default=[3, 5, 8])
+    parser.add_argument("--durations", type=comma_list(str), default=DURATION_CHOICES)
+    parser.add_argument("--scales", type=comma_list(str), default=SCALE_CHOICES[:1])
+    parser.add_argument("--stages", type=comma_list(str), default=STAGES)
+    parser.add_argument("--minimum-match", type=int, default=3)
+    parser.add_argument("--close-distance", type=int, default=2)
+    parser.add_argument("--max-sum-diffs", type=float, default=2)
+    parser.add_argument("--max-sum-diffs-classify", type=float, default=1)
+    parser.add_argument("--slow-max-pieces", type=int, default=5, help="largest size the slow stages run on: " + ", ".join(SLOW_STAGES))
+    parser.add_argument("--no-memory", action="store_true", help="skip the second, traced run of each stage")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for loading, as $CRIM_LOAD_WORKERS")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR))
+    parser.add_argument("--mei-dir", default=str(MEI_DIR))
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: " + ", ".join(sorted(unknown)))
+
+    paths = sorted(str(path) for path in Path(args.mei_dir).resolve().glob("*.mei"))
+    benchmark = Benchmark(args)
+    started = datetime.now(timezone.utc).isoformat()
+    for size in args.sizes:
+        benchmark.run_size(paths[:size])
+
+    parameters = {name: value for name, value in vars(args).items() if name not in ("output", "compare")}
+    Path(args.output).write_text(json.dumps({"started": started, "versions": _versions(), "parameters": parameters, "results": benchmark.records}, indent=1, default=str))
+    print("Wrote {} results to {}".format(len(benchmark.records), args.output))
+
+
+if __name__ == "__main__":
+    main()
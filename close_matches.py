@@ -0,0 +1,126 @@
+"""
+Close-match search through a metric index of interval patterns.
+
+crim_intervals.find_close_matches compares every distinct pattern with every
+window returned by into_patterns.  find_close_matches_indexed instead puts the
+distinct patterns in a VPTree (see ratio_distances) under the same L1
+distance, compares only the pairs of patterns the tree cannot rule out, and
+then expands those pairs to the windows having the patterns.
+"""
+import copy
+
+import numpy as np
+from crim_intervals import Match, PatternMatches, find_close_matches
+
+from ratio_distances import VPTree
+
+# distinct patterns gone through between two reports to a job
+PROGRESS_PATTERNS = 200
+
+
+def close_pattern_pairs(patterns, threshold):
+    """
+    All pairs (first, second) of rows of an integer matrix of patterns that are
+    at most threshold apart, in both orders and including each row with itself.
+    """
+    own = np.arange(len(patterns))
+    if threshold < 0:
+        return own[:0], own[:0]
+    first, second = VPTree(patterns.astype(float)).pairs_within(threshold)
+    # the tree returns candidates, checked here with the exact distance
+    kept = np.abs(patterns[first] - patterns[second]).sum(axis=1) <= threshold
+    first, second = first[kept], second[kept]
+    return np.concatenate((first, second, own)), np.concatenate((second, first, own))
+
+
+def find_close_matches_indexed(patterns_data, min_matches, threshold, job=None):
+    """
+    Same as crim_intervals.find_close_matches(patterns_data, min_matches, threshold):
+    a PatternMatches for each distinct pattern, in order of first appearance,
+    whose windows within threshold number more than min_matches.
+
+    Falls back to find_close_matches unless the patterns are integer vectors of
+    one length, as into_patterns makes them.
+
+    job (jobs.Job): job to report the distinct patterns gone through to; once
+        it is stopping, the matches of the patterns gone through so far are
+        returned, and job.partial is set
+    """
+    patterns = [pattern[0] for pattern in patterns_data]
+    lengths = set(map(len, patterns))
+    if len(lengths) != 1 or not all(type(vector) is int for pattern in patterns for vector in pattern):
+        return find_close_matches(patterns_data, min_matches, threshold)
+
+    print("Finding close matches...")
+    distinct, first_windows, inverse = np.unique(np.array(patterns, dtype=np.int64), axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    sizes = np.bincount(inverse, minlength=len(distinct))
+    # windows of each distinct pattern, in corpus order
+    windows = np.split(np.argsort(inverse, kind="stable"), np.cumsum(sizes)[:-1])
+
+    first, second = close_pattern_pairs(distinct, threshold)
+    neighbors = np.split(second[np.argsort(first, kind="stable")], np.cumsum(np.bincount(first, minlength=len(distinct)))[:-1])
+    close_windows = np.bincount(first, weights=sizes[second], minlength=len(distinct))
+
+    # a window can be close to several patterns; its Match is built once and copied
+    matches = {}
+    all_matches_list = []
+    for done, p in enumerate(np.argsort(first_windows)):
+        if job is not None and done % PROGRESS_PATTERNS == 0:
+            job.progress(done, len(distinct))
+            if job.stopping():
+                job.partial = True
+                break
+        if close_windows[p] <= min_matches:
+            continue
+        matches_list = PatternMatches(patterns[first_windows[p]], [])
+        for a in np.sort(np.concatenate([windows[q] for q in neighbors[p]])).tolist():
+            if a in matches:
+                matches_list.matches.append(copy.copy(matches[a]))
+            else:
+                matches[a] = Match(*patterns_data[a])
+                matches_list.matches.append(matches[a])
+        all_matches_list.append(matches_list)
+    else:
+        if job is not None:
+            job.progress(len(distinct), len(distinct))
+    print(str(len(all_matches_list)) + " melodic intervals had more than " + str(min_matches) + " exact or close matches.\n")
+    return all_matches_list
+
+
+def match_counts(patterns_data, minimum_matches, close_distances=()):
+    """
+    Numbers of patterns and of matches that find_exact_matches and
+    find_close_matches_indexed return for every minimum of matches and every
+    close distance given, counted without building any Match.
+
+    Returns a list of dicts with the search ("exact" or "close"),
+    minimum_match, close_distance (None for exact searches), patterns and
+    matches.
+    """
+    patterns = [pattern[0] for pattern in patterns_data]
+    if patterns:
+        distinct, inverse = np.unique(np.array(patterns, dtype=np.int64), axis=0, return_inverse=True)
+        sizes = np.bincount(inverse.reshape(-1), minlength=len(distinct))
+    else:
+        distinct, sizes = np.zeros((0, 0), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    def counts(search, close_distance, windows):
+        for minimum_match in minimum_matches:
+            kept = windows > minimum_match
+            yield {"search": search, "minimum_match": minimum_match, "close_distance": close_distance,
+                   "patterns": int(kept.sum()), "matches": int(windows[kept].sum())}
+
+    records = list(counts("exact", None, sizes))
+    if close_distances and len(distinct):
+        # the pairs within the widest distance, cut down for each narrower one
+        first, second = close_pattern_pairs(distinct, max(close_distances))
+        distances = np.abs(distinct[first] - distinct[second]).sum(axis=1)
+        for close_distance in close_distances:
+            within = distances <= close_distance
+            windows = np.bincount(first[within], weights=sizes[second[within]], minlength=len(distinct)).astype(np.int64)
+            records += counts("close", close_distance, windows)
+    else:
+        for close_distance in close_distances:
+            records += counts("close", close_distance, sizes)
+    return records
@@ -0,0 +1,397 @@
+"""
+Loading of CRIM corpora with a persistent on-disk cache of parsed pieces.
+
+Parsing MEI through music21 is the slowest step of every search, and the
+in-memory Streamlit cache is lost whenever the app restarts.  Each parsed
+piece is therefore stored on disk under the SHA-256 of its MEI source, so a
+piece is parsed at most once per version of the cache format and of music21.
+Scores are serialized with music21's freezeThaw module, because plain pickles
+lose the bookkeeping that lets notes find their measures.  Thawing a piece is
+only about 1.2 to 1.6 times faster than parsing it, but the cache is filled
+once, when the app is built (see bin/post_compile), with
+
+    python corpus_loading.py [MEI directory]
+
+so that restarts and redeploys start from it.  The cache lives in
+$CRIM_CACHE_DIR, by default .crim_cache next to the app.
+
+Titles and composers are read from the MEI header while a piece is parsed, so
+they are cached along with the score.
+
+Each loaded piece is also kept in an in-memory LRUCache as a single-piece
+CorpusBase, and the corpus for a selection is assembled by concatenating those
+pieces, so changing a selection only loads the pieces that were added to it.
+"""
+import argparse
+import gc
+import hashlib
+import io
+import multiprocessing
+import os
+import pickle
+import tempfile
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import music21
+from music21 import freezeThaw
+import requests
+from crim_intervals import CorpusBase
+
+from memory_cache import LRUCache
+
+# Bump whenever the content of a cache entry changes.
+CACHE_VERSION = 2
+
+MEINS = '{http://www.music-encoding.org/ns/mei}'
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("CRIM_CACHE_DIR", Path(__file__).resolve().parent / ".crim_cache"))
+
+
+def read_source(path):
+    """Returns the raw bytes of an MEI file path (starting with '/') or url"""
+    if path[0] == '/':
+        return Path(path).read_bytes()
+    response = requests.get(path)
+    response.raise_for_status()
+    return response.content
+
+
+def source_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def piece_cache_dir(cache_dir=DEFAULT_CACHE_DIR):
+    """Directory holding the cached pieces for this cache format and music21 version"""
+    return Path(cache_dir) / "pieces-v{}-music21-{}".format(CACHE_VERSION, music21.VERSION_STR)
+
+
+def read_header(data):
+    """
+    Returns the title and composer in the meiHead of MEI data, as a dict.
+
+    The data is parsed incrementally and parsing stops at the end of the
+    header, so the music itself is never read.
+    """
+    header = {"title": None, "composer": None}
+    ancestors = []
+    for event, element in ET.iterparse(io.BytesIO(data), events=("start", "end")):
+        if event == "start":
+            ancestors.append(element.tag)
+            continue
+        ancestors.pop()
+        if element.tag == MEINS + "meiHead":
+            break
+        # same element as meiHead//titleStmt/title, the first one wins
+        if element.tag == MEINS + "title" and ancestors[-1:] == [MEINS + "titleStmt"]:
+            if header["title"] is None:
+                header["title"] = element.text
+        elif element.tag == MEINS + "persName" and element.get("role") == "composer" and MEINS + "titleStmt" in ancestors:
+            if header["composer"] is None:
+                header["composer"] = element.text
+    return header
+
+
+def parse_piece(path, data):
+    """
+    Parses MEI data into a music21 Score the same way CorpusBase does.
+
+    music21 does not pick up the title and composer of CRIM files, so they are
+    copied into the score metadata from the MEI header.
+    """
+    if path[0] == '/':
+        score = music21.converter.subConverters.ConverterMEI().parseFile(path)
+    else:
+        score = music21.converter.parse(data.decode("utf-8"))
+    try:
+        header = read_header(data)
+    except ET.ParseError:
+        return score
+    if score.metadata is None:
+        score.insert(0, music21.metadata.Metadata())
+    if header["title"] is not None:
+        score.metadata.title = header["title"]
+    if header["composer"] is not None:
+        score.metadata.composer = header["composer"]
+    return score
+
+
+@contextmanager
+def _gc_paused():
+    # Thawing scores and building note lists create very large numbers of linked
+    # objects; the cyclic garbage collector would otherwise rescan them over and over.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _thaw(frozen):
+    with _gc_paused():
+        thawer = freezeThaw.StreamThawer()
+        thawer.openStr(frozen)
+        return thawer.stream
+
+
+def write_atomically(path, data):
+    """
+    Writes data to path through a temporary file, so that path is never left
+    half written, and concurrent readers never see a partial file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _cache_file(data, cache_dir):
+    if cache_dir is None:
+        return None
+    return piece_cache_dir(cache_dir) / "{}.pickle".format(source_digest(data))
+
+
+def _store(cache_file, path, score):
+    """Freezes score into the cache, returning the frozen bytes (or None if that failed)"""
+    try:
+        frozen = freezeThaw.StreamFreezer(score).writeStr(fmt="pickle")
+        if cache_file is not None:
+            write_atomically(cache_file, frozen)
+        return frozen
+    except (OSError, pickle.PicklingError, freezeThaw.FreezeThawException, RecursionError) as e:
+        print("Could not cache " + str(path) + ": " + str(e))
+        return None
+
+
+def load_piece(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the parsed music21 Score for one MEI file, from the disk cache if possible.
+
+    path (str): MEI file path (starting with '/') or url
+    cache_dir (str, Path): root of the on-disk cache, or None to always parse
+    """
+    data = read_source(path)
+    cache_file = _cache_file(data, cache_dir)
+    if cache_file is not None and cache_file.exists():
+        try:
+            return _thaw(cache_file.read_bytes())
+        except Exception:
+            print("Discarding unreadable cache entry " + str(cache_file))
+
+    score = parse_piece(path, data)
+    if cache_file is not None:
+        _store(cache_file, path, score)
+    return score
+
+
+def _load_frozen_piece(path, cache_dir):
+    """
+    Worker side of parallel loading: returns the frozen score of one piece, or None.
+
+    Scores have to travel between processes frozen, since plain pickles of
+    music21 streams are not usable.
+    """
+    try:
+        data = read_source(path)
+        cache_file = _cache_file(data, cache_dir)
+        if cache_file is not None and cache_file.exists():
+            return cache_file.read_bytes()
+        return _store(cache_file, path, parse_piece(path, data))
+    except Exception:
+        return None
+
+
+def _cache_piece(path, cache_dir):
+    # worker side of cache_pieces
+    try:
+        data = read_source(path)
+        cache_file = _cache_file(data, cache_dir)
+        if cache_file.exists():
+            return True
+        return _store(cache_file, path, parse_piece(path, data)) is not None
+    except Exception:
+        return False
+
+
+def cache_pieces(paths, cache_dir=DEFAULT_CACHE_DIR, workers=None):
+    """
+    Parses the pieces missing from the disk cache in a pool of worker
+    processes, without loading any of them here.  Returns the paths of the
+    pieces that are cached, leaving out those that could not be imported.
+    """
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        cached = [_cache_piece(path, cache_dir) for path in paths]
+    else:
+        with process_pool(workers) as executor:
+            cached = list(executor.map(_cache_piece, paths, repeat(cache_dir)))
+    return [path for path, ok in zip(paths, cached) if ok]
+
+
+def default_workers():
+    """Worker processes used for loading: $CRIM_LOAD_WORKERS, or one per CPU"""
+    return int(os.environ.get("CRIM_LOAD_WORKERS", 0)) or os.cpu_count() or 1
+
+
+def process_pool(workers):
+    """
+    A ProcessPoolExecutor of workers processes, started by a fork server (or
+    spawned where there is none) rather than forked: the app's server runs
+    threads, whose locks a forked child would inherit in whatever state
+    they were in.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+def assemble_corpus(paths, scores, stamps=None):
+    """
+    Builds a CorpusBase from already parsed scores without parsing anything again.
+
+    The corpus gets a cache_key attribute that identifies it for caching what is
+    computed from it: the paths of its pieces with their source stamps, so the
+    same pieces loaded again get the same key unless their files changed.
+
+    paths (list): paths or urls of the pieces, in the same order as scores
+    scores (list of music21.Score): parsed pieces
+    stamps (list): source stamps of the pieces (see _source_stamp), read from
+        the files if omitted
+    """
+    if stamps is None:
+        stamps = [_source_stamp(path) for path in paths]
+    corpus = CorpusBase.__new__(CorpusBase)
+    corpus.cache_key = tuple(zip(paths, stamps))
+    corpus.paths = list(paths)
+    corpus.scores = list(scores)
+    with _gc_paused():
+        corpus.note_list = corpus.note_list_whole_piece()
+        corpus.no_unisons = corpus.note_list_no_unisons()
+    return corpus
+
+
+def load_pieces(paths, cache_dir=DEFAULT_CACHE_DIR, workers=None):
+    """
+    Loads several pieces, parsing them in a pool of worker processes.
+
+    Returns a list of music21 Scores in the same order as paths, with None for
+    every piece that could not be imported.
+
+    workers (int): number of worker processes, defaults to default_workers();
+        with 1 the pieces are loaded one after another in this process
+    """
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        scores = []
+        for path in paths:
+            try:
+                scores.append(load_piece(path, cache_dir))
+            except Exception:
+                scores.append(None)
+        return scores
+
+    with process_pool(workers) as executor:
+        # map() yields in submission order, whatever order the workers finish in
+        frozen_scores = list(executor.map(_load_frozen_piece, paths, repeat(cache_dir)))
+    return [_thaw(frozen) if frozen is not None else None for frozen in frozen_scores]
+
+
+def _source_stamp(path):
+    """Cheap fingerprint used to notice that a local file changed since it was loaded"""
+    if path[0] == '/':
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    return path
+
+
+def combine_corpora(pieces):
+    """
+    Concatenates single-piece corpora into one CorpusBase.
+
+    The result matches CorpusBase(paths) except for the prev_note of the first
+    note of each piece, which is not linked to the piece before it.  Its
+    cache_key combines those of the pieces (see assemble_corpus).
+    """
+    corpus = CorpusBase.__new__(CorpusBase)
+    corpus.cache_key = tuple(piece.cache_key for piece in pieces)
+    corpus.paths, corpus.scores, corpus.note_list, corpus.no_unisons = [], [], [], []
+    for piece in pieces:
+        corpus.paths.extend(piece.paths)
+        corpus.scores.extend(piece.scores)
+        corpus.note_list.extend(piece.note_list)
+        corpus.no_unisons.extend(piece.no_unisons)
+    return corpus
+
+
+def load_corpus(paths, cache_dir=DEFAULT_CACHE_DIR, workers=None, cache=None, owner=None):
+    """
+    Drop-in replacement for CorpusBase(paths) backed by the piece caches.
+
+    Like CorpusBase, pieces that fail to import are skipped, and an Exception is
+    raised if none of them could be imported.
+
+    cache (LRUCache): in-memory cache shared between calls, holding a
+        single-piece corpus under ("piece", path); only the pieces missing from
+        it are loaded (in parallel, see load_pieces)
+    owner: if given, pins the pieces of paths in cache for owner (see
+        LRUCache.pin), in place of the pieces it pinned before, so that the
+        selection stays cached however large it is
+    """
+    if cache is None:
+        cache = LRUCache(max_bytes=None)
+    if owner is not None:
+        cache.pin(owner, [("piece", path) for path in paths], group="pieces")
+    pieces, missing = {}, []
+    for path in paths:
+        stamp = _source_stamp(path)
+        cached = cache.get(("piece", path))
+        if stamp is not None and cached is not None and cached[0] == stamp:
+            pieces[path] = cached[1]
+        else:
+            missing.append((path, stamp))
+
+    # pieces are held here until the corpus is assembled, as the cache may
+    # evict some of them again while the others are loading
+    for (path, stamp), score in zip(missing, load_pieces([path for path, _ in missing], cache_dir, workers)):
+        if score is None:
+            cache.pop(("piece", path))
+            print("Import of " + str(path) + " failed, please check your file path/url. Continuing to next file...")
+            continue
+        pieces[path] = assemble_corpus([path], [score], [stamp])
+        cache.put(("piece", path), (stamp, pieces[path]))
+
+    if len(pieces) == 0:
+        raise Exception("At least one score must be succesfully imported")
+    return combine_corpora([pieces[path] for path in paths if path in pieces])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse MEI files into the piece cache used by the app.")
+    parser.add_argument("mei_dir", nargs="?", default=str(Path(__file__).resolve().parent / "mei"), help="directory of MEI files to cache")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR), help="cache directory, as $CRIM_CACHE_DIR in the app")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, as $CRIM_LOAD_WORKERS")
+    args = parser.parse_args()
+
+    paths = sorted(str(path) for path in Path(args.mei_dir).resolve().glob("*.mei"))
+    cached = cache_pieces(paths, args.cache_dir, args.workers)
+    print("Cached {} of {} pieces in {}".format(len(cached), len(paths), piece_cache_dir(args.cache_dir)))
+
+
+if __name__ == "__main__":
+    main()
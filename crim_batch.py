@@ -0,0 +1,287 @@
+"""
+Runs the searches of the app over many pieces from the command line.
+
+    python crim_batch.py mei/ --per-piece --vector-lengths 4,5,6 --output-dir batch_results
+    python crim_batch.py mei/CRIM_Model_0008.mei mei/CRIM_Mass_0005_1.mei --stages exact,exact_classified
+    python crim_batch.py mei/ --sweep --vector-lengths 1-20 --minimum-matches 3,5 --close-distances 1-4
+
+The pipeline is the app's: load, intervals, patterns, exact and close
+matches, the duration filter of Step 6 and the classifier of Step 7, for
+every combination of the duration modes, scales and vector lengths given.
+The pieces are searched together, as one selection in the app, or with
+--per-piece each on its own.  Every (selection, duration mode, scale, vector
+length) is a unit of work, run in a pool of worker processes; units of the
+same selection and duration mode are submitted together, so that a worker
+mostly reuses the corpus and interval base it loaded for the one before.
+
+Each stage writes one file per parameter set,
+
+    <output-dir>/<selection>/<stage>_<duration>_<scale>_V<length>_M<minimum>[_C<close>][_D<max sum diffs>].<ext>
+
+named after the app's search summaries.  Files are written whole or not at
+all, and stages whose file exists are not run again, so an interrupted run
+picks up where it stopped when started again with the same arguments.  The
+stage timings of each unit are appended to <output-dir>/batch_log.jsonl.
+
+With --sweep, only the numbers of patterns and matches are counted, for
+every combination of the parameters given, and written as one table to
+<output-dir>/sweep_<selection>.<ext> (see sweep.py).
+"""
+import argparse
+import sys
+from concurrent.futures import as_completed
+from pathlib import Path
+
+from crim_intervals import classify_matches, export_pandas, find_exact_matches, into_patterns
+
+from close_matches import find_close_matches_indexed
+from corpus_loading import DEFAULT_CACHE_DIR, cache_pieces, default_workers, load_corpus, process_pool, write_atomically
+from exports import EXPORT_FORMATS, export_bytes, export_file_name
+from instrumentation import RunTimings
+from interval_index import IntervalIndex
+from memory_cache import worker_cache
+from pipeline import DURATION_CHOICES, SCALE_CHOICES, classified_matches_to_pandas, duration_filter, interval_base, scale_intervals
+from sweep import run_sweep
+
+# stages that write files, with the thresholds their file names carry
+STAGES = {
+    "exact": (),
+    "close": ("close_distance",),
+    "exact_durations": ("max_sum_diffs",),
+    "close_durations": ("close_distance", "max_sum_diffs"),
+    "exact_classified": ("max_sum_diffs_classify",),
+    "close_classified": ("close_distance", "max_sum_diffs_classify"),
+}
+
+_NAME_LETTERS = {"close_distance": "C", "max_sum_diffs": "D", "max_sum_diffs_classify": "D"}
+
+MEI_DIR = Path(__file__).resolve().parent / "mei"
+
+
+def stage_file(output_dir, selection, stage, params, export_format):
+    """Path of the file written by stage for one parameter set"""
+    name = "{}_{}_{}_V{}_M{}".format(stage, params["duration"], params["scale"], params["vector_length"], params["minimum_match"])
+    for threshold in STAGES[stage]:
+        name += "_{}{}".format(_NAME_LETTERS[threshold], params[threshold])
+    return Path(output_dir) / selection / export_file_name(name, export_format)
+
+
+class Unit:
+    """
+    The searches of one selection of pieces with one set of patterns.
+
+    selection (str): name of the selection, the directory its files go to
+    paths (list): MEI files of the selection
+    duration (str): one of DURATION_CHOICES
+    scale (str): one of SCALE_CHOICES
+    vector_length (int): length of the patterns
+    """
+    def __init__(self, selection, paths, duration, scale, vector_length, args):
+        self.selection = selection
+        self.paths = paths
+        self.duration = duration
+        self.scale = scale
+        self.vector_length = vector_length
+        self.args = args
+        self.params = {
+            "duration": duration, "scale": scale, "vector_length": vector_length,
+            "minimum_match": args.minimum_match, "close_distance": args.close_distance,
+            "max_sum_diffs": args.max_sum_diffs, "max_sum_diffs_classify": args.max_sum_diffs_classify,
+        }
+
+    def __str__(self):
+        return "{} {} {} V{}".format(self.selection, self.duration, self.scale, self.vector_length)
+
+    def missing(self):
+        """Stages whose files are not written yet"""
+        return [stage for stage in self.args.stages if not stage_file(self.args.output_dir, self.selection, stage, self.params, self.args.format).exists()]
+
+    def done(self):
+        return not self.missing()
+
+    def run(self, cache=None):
+        """
+        Runs the stages missing from the output, returning the unit's timings as a JSON line.
+
+        cache (LRUCache): cache of pieces and interval bases, see load_corpus and
+            interval_base; each worker process keeps its own by default
+        """
+        if cache is None:
+            cache = worker_cache()
+        args = self.args
+        timings = RunTimings()
+        with timings.stage("load"):
+            corpus = load_corpus(self.paths, args.cache_dir, workers=1, cache=cache)
+        with timings.stage("intervals"):
+            vectors = interval_base(corpus, self.duration, cache)
+        index = IntervalIndex(args.cache_dir)
+        missing = self.missing()
+        with timings.stage("patterns"):
+            patterns = into_patterns([scale_intervals(vectors, self.scale)], self.vector_length)
+        written = []
+        for kind in ("exact", "close"):
+            stages = [stage for stage in missing if stage.startswith(kind)]
+            if stages:
+                written += self._search(kind, stages, self.params, patterns, index, timings)
+        return timings.log_line(selection=self.selection, pieces=len(self.paths), duration=self.duration, scale=self.scale,
+                                vector_length=self.vector_length, written=written)
+
+    def _search(self, kind, stages, params, patterns, index, timings):
+        # the exact or close stages of one parameter set
+        matches = results = None
+        if kind == "exact" and "exact_classified" not in stages:
+            with timings.stage("matching (index)"):
+                results = index.exact_matches(self.paths, self.duration, params["scale"], params["vector_length"], params["minimum_match"])
+        if results is None:
+            with timings.stage("matching"):
+                if kind == "exact":
+                    matches = find_exact_matches(patterns, params["minimum_match"])
+                else:
+                    matches = find_close_matches_indexed(patterns, params["minimum_match"], params["close_distance"])
+            with timings.stage("export_pandas"):
+                results = export_pandas(matches)
+
+        tables = {}
+        if kind + "_durations" in stages:
+            # duration_filter adds a duration_ratios column, which the Step 5
+            # table of the app does not have
+            with timings.stage("ratio distances"):
+                tables[kind + "_durations"] = duration_filter(results.copy(), params["max_sum_diffs"])
+            if kind == "close":
+                tables[kind + "_durations"] = tables[kind + "_durations"].sort_values(["match_1_start_measure"])
+        if kind in stages:
+            tables[kind] = results
+        if kind + "_classified" in stages:
+            with timings.stage("classify"):
+                tables[kind + "_classified"] = classified_matches_to_pandas(classify_matches(matches, params["max_sum_diffs_classify"]))
+
+        written = []
+        for stage, table in tables.items():
+            path = stage_file(self.args.output_dir, self.selection, stage, params, self.args.format)
+            with timings.stage("export"):
+                write_atomically(path, export_bytes(table, self.args.format))
+            written.append(str(path))
+        return written
+
+
+def _run_unit(unit):
+    # worker side of main; errors are reported rather than ending the batch
+    try:
+        return unit.run(), None
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+
+def mei_paths(sources):
+    """The MEI files given, with directories standing for the .mei files in them"""
+    paths = []
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            paths += sorted(str(path) for path in source.resolve().glob("*.mei"))
+        else:
+            paths.append(str(source.resolve()))
+    return paths
+
+
+def sweep(args, selections, workers):
+    """Writes the sweep table of each selection, see sweep.run_sweep"""
+    cached = set(cache_pieces(sorted({path for _, paths in selections for path in paths}), args.cache_dir, workers))
+    for selection, paths in selections:
+        paths = [path for path in paths if path in cached]
+        if not paths:
+            continue
+        table = run_sweep(paths, args.durations, args.scales, args.vector_lengths, args.minimum_matches or [args.minimum_match],
+                          args.close_distances or [args.close_distance], args.cache_dir, workers)
+        path = Path(args.output_dir) / export_file_name("sweep_" + selection, args.format)
+        write_atomically(path, export_bytes(table, args.format))
+        print("Wrote {} grid points to {}".format(len(table), path), flush=True)
+
+
+def comma_list(convert):
+    """argparse type of a comma separated list, each item passed to convert"""
+    return lambda text: [convert(item) for item in text.split(",") if item]
+
+
+def _int_list(text):
+    # comma separated, with ranges such as 1-20
+    values = []
+    for item in text.split(","):
+        if "-" in item.strip("-"):
+            first, last = item.split("-")
+            values += range(int(first), int(last) + 1)
+        elif item:
+            values.append(int(item))
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the app's searches over MEI files, writing the results of every stage.")
+    parser.add_argument("pieces", nargs="*", default=[str(MEI_DIR)], help="MEI files or directories of them (default: mei/)")
+    parser.add_argument("--per-piece", action="store_true", help="search every piece on its own rather than all together")
+    parser.add_argument("--name", default="selection", help="directory name of the selection, without --per-piece")
+    parser.add_argument("--durations", type=comma_list(str), default=DURATION_CHOICES[:1], help="duration modes, comma separated")
+    parser.add_argument("--scales", type=comma_list(str), default=SCALE_CHOICES[:1], help="interval scales, comma separated")
+    parser.add_argument("--vector-lengths", type=_int_list, default=[5], help="comma separated, or ranges such as 1-20")
+    parser.add_argument("--minimum-match", type=int, default=3)
+    parser.add_argument("--close-distance", type=int, default=2)
+    parser.add_argument("--max-sum-diffs", type=float, default=2)
+    parser.add_argument("--max-sum-diffs-classify", type=float, default=1)
+    parser.add_argument("--sweep", action="store_true", help="count the patterns and matches of every combination of parameters instead")
+    parser.add_argument("--minimum-matches", type=_int_list, default=None, help="with --sweep, as --vector-lengths (default: --minimum-match)")
+    parser.add_argument("--close-distances", type=_int_list, default=None, help="with --sweep, as --vector-lengths (default: --close-distance)")
+    parser.add_argument("--stages", type=comma_list(str), default=list(STAGES), help="comma separated, of: " + ", ".join(STAGES))
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="Parquet" if "Parquet" in EXPORT_FORMATS else "CSV")
+    parser.add_argument("--output-dir", default="batch_results")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, as $CRIM_LOAD_WORKERS")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR), help="cache directory, as $CRIM_CACHE_DIR in the app")
+    args = parser.parse_args()
+
+    for name, given, known in (("stages", args.stages, STAGES), ("durations", args.durations, DURATION_CHOICES), ("scales", args.scales, SCALE_CHOICES)):
+        unknown = set(given) - set(known)
+        if unknown:
+            parser.error("unknown {}: {}".format(name, ", ".join(sorted(unknown))))
+    workers = args.workers or default_workers()
+
+    paths = mei_paths(args.pieces)
+    if args.per_piece:
+        selections = [(Path(path).stem, [path]) for path in paths]
+    else:
+        selections = [(args.name, paths)]
+    if args.sweep:
+        sweep(args, selections, workers)
+        return
+    units = [Unit(selection, selection_paths, duration, scale, vector_length, args)
+             for selection, selection_paths in selections for duration in args.durations for scale in args.scales for vector_length in args.vector_lengths]
+    todo = [unit for unit in units if not unit.done()]
+    print("{} of {} units to run".format(len(todo), len(units)), flush=True)
+    if not todo:
+        return
+
+    # parses every piece once, so that the workers only read the piece cache
+    cached = set(cache_pieces(sorted({path for unit in todo for path in unit.paths}), args.cache_dir, workers))
+    for unit in todo:
+        unit.paths = [path for path in unit.paths if path in cached]
+    todo = [unit for unit in todo if unit.paths]
+
+    failed = 0
+    log_file = Path(args.output_dir) / "batch_log.jsonl"
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with process_pool(min(workers, len(todo))) as executor, open(log_file, "a") as log:
+        futures = {executor.submit(_run_unit, unit): unit for unit in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            unit = futures[future]
+            line, error = future.result()
+            if error is None:
+                log.write(line + "\n")
+                log.flush()
+                print("[{}/{}] {}".format(done, len(todo), unit), flush=True)
+            else:
+                failed += 1
+                print("[{}/{}] {} failed: {}".format(done, len(todo), unit, error), flush=True)
+    if failed:
+        sys.exit("{} of {} units failed".format(failed, len(todo)))
+
+
+if __name__ == "__main__":
+    main()
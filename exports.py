@@ -0,0 +1,68 @@
+"""
+Result tables as downloadable files: CSV, gzipped CSV and, with pyarrow, Parquet.
+
+The app used to embed each CSV, base64 encoded, in a data: link on the page.
+Files are now written into a single buffer, CSV a chunk of rows at a time, and
+served by st.download_button as files of their own.
+"""
+import gzip
+import io
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows converted to CSV text at a time
+CSV_CHUNK_ROWS = 10000
+
+# file extension and MIME type of each format offered
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    "CSV (gzip)": (".csv.gz", "application/gzip"),
+}
+if pyarrow is not None:
+    EXPORT_FORMATS["Parquet"] = (".parquet", "application/vnd.apache.parquet")
+
+
+def write_csv(df, f, chunk_rows=CSV_CHUNK_ROWS):
+    """Writes df to the binary file f as UTF-8 CSV, chunk_rows rows at a time"""
+    if len(df) == 0:
+        f.write(df.to_csv(index=False).encode("utf-8"))
+    for start in range(0, len(df), chunk_rows):
+        f.write(df.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0).encode("utf-8"))
+
+
+def _arrow_table(df):
+    columns = {}
+    for name in df.columns:
+        try:
+            columns[str(name)] = pyarrow.array(df[name], from_pandas=True)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+            # e.g. beats mixing floats with music21's Fractions
+            columns[str(name)] = pyarrow.array(df[name].astype(str))
+    return pyarrow.table(columns)
+
+
+def export_bytes(df, export_format):
+    """Returns df as a file in one of EXPORT_FORMATS"""
+    buffer = io.BytesIO()
+    if export_format == "CSV":
+        write_csv(df, buffer)
+    elif export_format == "CSV (gzip)":
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as f:
+            write_csv(df, f)
+    elif export_format == "Parquet" and pyarrow is not None:
+        pyarrow.parquet.write_table(_arrow_table(df), buffer)
+    else:
+        raise ValueError("Unknown export format: " + str(export_format))
+    return buffer.getvalue()
+
+
+def export_file_name(name, export_format):
+    """name with the extension of export_format, replacing a .csv extension typed in"""
+    extension = EXPORT_FORMATS[export_format][0]
+    if name.lower().endswith(".csv"):
+        name = name[:-len(".csv")]
+    return name + extension
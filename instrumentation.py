@@ -0,0 +1,94 @@
+"""
+Timing and memory of the stages of one run of the app.
+
+Each stage of a run (loading, intervals, patterns, matching, export_pandas,
+ratio distances, rendering, ...) is wrapped in RunTimings.stage(), which
+records its wall time, CPU time and memory.  The app shows the stages of the
+current run in an optional sidebar panel and prints them as one JSON line
+per run, for the platform's log.
+
+Stages are disjoint: a stage run inside another (export inside render, say)
+is only counted in its own record, and left out of the times of the stages
+around it, so the times of a run add up.  CPU time is that of the thread
+running the stage, which leaves out the other sessions and background jobs
+sharing the process.
+
+Memory is the process' current resident size at the end of the stage, and
+its change over the stage (less that of the stages inside), read from /proc
+where there is one; with
+trace_memory (or $CRIM_TRACE_MEMORY set) the peak of Python allocations in
+the stage is recorded too, through tracemalloc, at the price of running the
+stages a few times slower.
+"""
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+TRACE_MEMORY = bool(os.environ.get("CRIM_TRACE_MEMORY"))
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else None
+
+
+def _rss_bytes():
+    # the peak resident size from getrusage stops growing once a long-running
+    # server has warmed up, so the current size is read instead
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, TypeError, ValueError, IndexError):
+        return None
+
+
+class RunTimings:
+    """
+    The stages measured in one run, in the order they finished.
+
+    trace_memory (bool): also record the peak Python allocations of each stage
+    """
+    def __init__(self, trace_memory=TRACE_MEMORY):
+        self.trace_memory = trace_memory
+        self.started = time.time()
+        self.stages = []
+        # [seconds, cpu_seconds, rss_change_bytes] of the stages inside each running stage
+        self._inner = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measures the code run in the with block, less the stages inside it, as the stage name"""
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        rss = _rss_bytes()
+        self._inner.append([0.0, 0.0, 0])
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            seconds, cpu_seconds = time.perf_counter() - wall, time.thread_time() - cpu
+            rss_now = _rss_bytes()
+            rss_change = 0 if rss is None or rss_now is None else rss_now - rss
+            inner = self._inner.pop()
+            if self._inner:
+                for total, value in enumerate((seconds, cpu_seconds, rss_change)):
+                    self._inner[-1][total] += value
+            record = {
+                "stage": name,
+                "seconds": seconds - inner[0],
+                "cpu_seconds": cpu_seconds - inner[1],
+                "rss_bytes": rss_now,
+                "rss_change_bytes": None if rss_now is None else rss_change - inner[2],
+                "peak_allocated_bytes": None,
+            }
+            if tracing:
+                record["peak_allocated_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages.append(record)
+
+    def total_seconds(self):
+        return time.time() - self.started
+
+    def log_line(self, **context):
+        """The run as one line of JSON, with context such as the parameters searched"""
+        return json.dumps({"event": "run", "started": self.started, "seconds": self.total_seconds(), **context, "stages": self.stages}, default=str)
@@ -0,0 +1,477 @@
+"""
+An inverted index of interval n-grams over the pieces in mei/, for exact search.
+
+For every duration mode and interval scale the index holds the intervals of
+each piece and the positions of those intervals sorted by the intervals that
+follow them (up to MAX_LENGTH of them, stopping at rests and at the end of the
+piece), i.e. a suffix array.  All occurrences of an n-gram are adjacent in that
+order, so the postings of every n-gram of any length up to MAX_LENGTH are runs
+of it, and an exact search becomes counting the runs that fall in the selected
+pieces instead of building and comparing patterns.
+
+The index is built offline, into the same cache directory as the parsed
+pieces, with
+
+    python interval_index.py [MEI directory]
+
+which bin/post_compile runs when the app is built.  A search only uses the
+index if every selected piece is indexed with its current MEI source, and
+under the current versions of music21 and crim_intervals.  Results are the same as those of
+
+    export_pandas(find_exact_matches(into_patterns([intervals], vector_length), minimum_match))
+
+including the windows that span two consecutive pieces of the selection
+(see tests/test_interval_index.py).
+"""
+import argparse
+import importlib.metadata
+import os
+import pickle
+import threading
+from bisect import bisect_left
+from itertools import repeat
+from pathlib import Path
+
+import music21
+import numpy as np
+import pandas as pd
+from crim_intervals import IntervalBase, NoteListElement
+
+from corpus_loading import DEFAULT_CACHE_DIR, assemble_corpus, default_workers, load_piece, process_pool, read_source, source_digest, write_atomically
+from pipeline import DURATION_CHOICES, SCALE_CHOICES, note_list, scale_intervals
+
+# Bump whenever the content of an index file changes.
+INDEX_VERSION = 1
+
+CRIM_INTERVALS_VERSION = importlib.metadata.version("crim_intervals")
+
+# the longest n-gram that can be looked up, the app's largest vector length
+MAX_LENGTH = 20
+
+# code of a "Rest" interval, and of the gap after the last note of a piece
+REST = np.iinfo(np.int64).min
+
+NOTE_COLUMNS = ["rest", "pitch", "measure", "beat", "offset", "duration", "part", "part_number"]
+
+
+def index_dir(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Directory holding the index for this index format and the music21 and
+    crim_intervals versions, whose note lists and patterns the index reproduces
+    """
+    return Path(cache_dir) / "interval-index-v{}-music21-{}-crim_intervals-{}".format(INDEX_VERSION, music21.VERSION_STR, CRIM_INTERVALS_VERSION)
+
+
+def _index_file(cache_dir, duration_choice):
+    return index_dir(cache_dir) / "{}.pickle".format(duration_choice)
+
+
+# building the index
+
+def _note_columns(notes):
+    """What export_pandas reads from the notes of a note list, as columns"""
+    columns = {name: [] for name in NOTE_COLUMNS}
+    for element in notes:
+        rest = element.note.isRest
+        columns["rest"].append(rest)
+        # rests never start or end a pattern, so only notes need their position
+        columns["pitch"].append(None if rest else element.note.nameWithOctave)
+        columns["measure"].append(None if rest else element.note.measureNumber)
+        columns["beat"].append(None if rest else element.note.beat)
+        columns["offset"].append(element.offset)
+        columns["duration"].append(element.duration)
+        columns["part"].append(element.part)
+        columns["part_number"].append(element.partNumber)
+    return columns
+
+
+def _interval_codes(intervals):
+    """Interval vectors as int64 codes, with REST for "Rest" and after the last note"""
+    codes = []
+    for interval in intervals:
+        if interval.vector == "Rest":
+            codes.append(REST)
+        elif type(interval.vector) is int:
+            codes.append(interval.vector)
+        else:
+            raise ValueError("Cannot index interval " + str(interval.vector))
+    codes.append(REST)
+    return codes
+
+
+def index_piece(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Returns the note columns and interval codes of one piece in every duration
+    mode, as plain Python data.
+    """
+    data = read_source(path)
+    corpus = assemble_corpus([path], [load_piece(path, cache_dir)])
+    piece = {"name": Path(path).name, "digest": source_digest(data), "title": corpus.scores[0].metadata.title, "modes": {}}
+    for duration_choice in DURATION_CHOICES:
+        vectors = IntervalBase(note_list(corpus, duration_choice))
+        piece["modes"][duration_choice] = {
+            "notes": _note_columns(vectors.notes),
+            "codes": {scale_choice: _interval_codes(scale_intervals(vectors, scale_choice)) for scale_choice in SCALE_CHOICES},
+        }
+    return piece
+
+
+def _index_piece_or_none(path, cache_dir):
+    # worker side of build_index
+    try:
+        return index_piece(path, cache_dir)
+    except Exception as e:
+        print("Could not index " + str(path) + ": " + str(e))
+        return None
+
+
+def _valid_lengths(codes):
+    """Number of intervals before the next REST from every position, at most MAX_LENGTH"""
+    rest_positions = np.flatnonzero(codes == REST)
+    next_rest = rest_positions[np.searchsorted(rest_positions, np.arange(len(codes)))]
+    return np.minimum(next_rest - np.arange(len(codes)), MAX_LENGTH).astype(np.int8)
+
+
+def _windows(codes, valid_lengths, positions):
+    """The MAX_LENGTH intervals from each position, padded with REST past its valid length"""
+    columns = np.arange(MAX_LENGTH)
+    padded = np.concatenate((codes, np.full(MAX_LENGTH, REST)))
+    windows = padded[positions[:, None] + columns[None, :]]
+    windows[columns[None, :] >= valid_lengths[positions][:, None]] = REST
+    return windows
+
+
+def suffix_order(codes):
+    """
+    Sorts the positions of codes that start at least one interval by the
+    intervals that follow them.  Returns the sorted positions, the length of
+    the prefix each shares with the one before it (the LCP array) and the
+    valid length of every position.
+    """
+    valid_lengths = _valid_lengths(codes)
+    positions = np.flatnonzero(valid_lengths > 0)
+    windows = _windows(codes, valid_lengths, positions)
+    sorting = np.lexsort(windows.T[::-1])
+    order = positions[sorting]
+    windows = windows[sorting]
+    shared = np.cumprod(windows[1:] == windows[:-1], axis=1).sum(axis=1)
+    shared = np.minimum(shared, np.minimum(valid_lengths[order[1:]], valid_lengths[order[:-1]]))
+    return order, np.concatenate(([0], shared)).astype(np.int8), valid_lengths
+
+
+def _mode_index(pieces, duration_choice):
+    """Concatenates the pieces for one duration mode and sorts their suffixes"""
+    notes = {name: [] for name in NOTE_COLUMNS}
+    codes = {scale_choice: [] for scale_choice in SCALE_CHOICES}
+    note_counts = []
+    for piece in pieces:
+        mode = piece["modes"][duration_choice]
+        for name in NOTE_COLUMNS:
+            notes[name].extend(mode["notes"][name])
+        for scale_choice in SCALE_CHOICES:
+            codes[scale_choice].extend(mode["codes"][scale_choice])
+        note_counts.append(len(mode["notes"]["rest"]))
+
+    note_columns = {}
+    for name in NOTE_COLUMNS:
+        note_columns[name] = np.empty(len(notes[name]), dtype=bool if name == "rest" else object)
+        note_columns[name][:] = notes[name]
+    scales = {}
+    for scale_choice in SCALE_CHOICES:
+        scale_codes = np.array(codes[scale_choice], dtype=np.int64)
+        order, shared, valid_lengths = suffix_order(scale_codes)
+        scales[scale_choice] = {"codes": scale_codes, "order": order, "lcp": shared, "valid_lengths": valid_lengths}
+    return {
+        "pieces": {piece["name"]: (number, piece["digest"]) for number, piece in enumerate(pieces)},
+        "titles": [piece["title"] for piece in pieces],
+        "note_starts": np.concatenate(([0], np.cumsum(note_counts))),
+        "notes": note_columns,
+        "scales": scales,
+    }
+
+
+def build_index(paths, cache_dir=DEFAULT_CACHE_DIR, workers=None):
+    """
+    Indexes the pieces at paths, writing one index file per duration mode.
+
+    Pieces are parsed (or read from the piece cache) in a pool of worker
+    processes, see corpus_loading.load_pieces.  Returns the number of pieces
+    indexed.
+    """
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        pieces = [_index_piece_or_none(path, cache_dir) for path in paths]
+    else:
+        with process_pool(workers) as executor:
+            pieces = list(executor.map(_index_piece_or_none, paths, repeat(cache_dir)))
+    pieces = [piece for piece in pieces if piece is not None]
+
+    for duration_choice in DURATION_CHOICES:
+        frozen = pickle.dumps(_mode_index(pieces, duration_choice), protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomically(_index_file(cache_dir, duration_choice), frozen)
+    return len(pieces)
+
+
+# searching the index
+
+class IntervalIndex:
+    """
+    Exact search through the index files in cache_dir.
+
+    Index files are read when first needed, and an IntervalIndex can be shared
+    between the threads of concurrent Streamlit sessions.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._modes = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _mode(self, duration_choice):
+        with self._lock:
+            if duration_choice not in self._modes:
+                try:
+                    with open(_index_file(self.cache_dir, duration_choice), "rb") as f:
+                        mode = pickle.load(f)
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    mode = None
+                if mode is not None:
+                    mode["piece_of_note"] = np.repeat(np.arange(len(mode["titles"])), np.diff(mode["note_starts"]))
+                self._modes[duration_choice] = mode
+            return self._modes[duration_choice]
+
+    def _digest(self, path):
+        # MEI sources are hashed once per version of the file
+        try:
+            stat = os.stat(path) if path[0] == '/' else None
+        except OSError:
+            return None
+        key = (path, stat.st_mtime_ns, stat.st_size) if stat is not None else None
+        if key is None or key not in self._digests:
+            try:
+                digest = source_digest(read_source(path))
+            except Exception:
+                return None
+            if key is None:
+                return digest
+            self._digests[key] = digest
+        return self._digests[key]
+
+    def covers(self, paths, duration_choice):
+        """Whether every piece at paths is indexed, with its current source, for a duration mode"""
+        return self._piece_numbers(paths, duration_choice) is not None
+
+    def _piece_numbers(self, paths, duration_choice):
+        mode = self._mode(duration_choice)
+        if mode is None or len(paths) == 0:
+            return None
+        numbers = []
+        for path in paths:
+            number, digest = mode["pieces"].get(Path(path).name, (None, None))
+            if number is None or digest != self._digest(path):
+                return None
+            numbers.append(number)
+        return numbers
+
+    def exact_matches(self, paths, duration_choice, scale_choice, vector_length, minimum_match):
+        """
+        Returns the DataFrame export_pandas would for an exact search over the
+        corpus of the pieces at paths, or None if the index cannot answer it.
+
+        paths (list): MEI file paths as passed to load_corpus, in the same order
+        """
+        if not 1 <= vector_length <= MAX_LENGTH or len(set(paths)) != len(paths):
+            return None
+        numbers = self._piece_numbers(paths, duration_choice)
+        if numbers is None:
+            return None
+        mode = self._mode(duration_choice)
+        return _Search(mode, duration_choice, scale_choice, paths, numbers, vector_length).matches(minimum_match)
+
+
+class _Search:
+    """
+    One exact search over a selection of indexed pieces.
+
+    Positions in the corpus of the selection (the note list of the pieces at
+    paths, concatenated in their order) are called selected positions, and
+    positions in the index are called indexed positions.
+    """
+    def __init__(self, mode, duration_choice, scale_choice, paths, numbers, vector_length):
+        self.mode = mode
+        self.scale = mode["scales"][scale_choice]
+        self.scale_choice = scale_choice
+        # CorpusBase.note_list_incremental_offset gives every note the path of
+        # the first piece, which is what ema_url is made from
+        self.paths = paths if duration_choice == "Actual" else [paths[0]] * len(paths)
+        self.numbers = np.array(numbers)
+        self.n = vector_length
+
+        note_starts = mode["note_starts"]
+        self.note_counts = np.diff(note_starts)[self.numbers]
+        # first selected position of each selected piece, and one past the last
+        self.selected_starts = np.concatenate(([0], np.cumsum(self.note_counts)))
+        self.total = self.selected_starts[-1]
+        self.rank_of_piece = np.full(len(note_starts) - 1, -1)
+        self.rank_of_piece[self.numbers] = np.arange(len(self.numbers))
+
+    def _indexed_positions(self, selected):
+        ranks = np.searchsorted(self.selected_starts, selected, side="right") - 1
+        return self.mode["note_starts"][self.numbers[ranks]] + selected - self.selected_starts[ranks], ranks
+
+    def _junction_code(self, rank):
+        """The interval from the last note of the selected piece rank to the first note of the next one"""
+        notes = self.mode["notes"]
+        last = self.mode["note_starts"][self.numbers[rank] + 1] - 1
+        first = self.mode["note_starts"][self.numbers[rank + 1]]
+        if notes["rest"][last] or notes["rest"][first]:
+            return REST
+        pair = [NoteListElement(music21.note.Note(notes["pitch"][i]), None, None, None, None, None) for i in (last, first)]
+        return _interval_codes(scale_intervals(IntervalBase(pair), self.scale_choice))[0]
+
+    def _selected_codes(self, selected):
+        """Codes of the intervals that follow selected positions, across junctions of pieces"""
+        indexed, ranks = self._indexed_positions(selected)
+        codes = self.scale["codes"][indexed]
+        at_junction = (selected == self.selected_starts[ranks + 1] - 1) & (ranks < len(self.numbers) - 1)
+        for rank in np.unique(ranks[at_junction]):
+            codes[at_junction & (ranks == rank)] = self._junction_code(rank)
+        return codes
+
+    def _indexed_postings(self):
+        """Group and selected position of every window lying within a selected piece"""
+        order = self.scale["order"]
+        group_ids = np.cumsum(self.scale["lcp"] < self.n) - 1
+        piece_ranks = self.rank_of_piece[self.mode["piece_of_note"][order]]
+        kept = (self.scale["valid_lengths"][order] >= self.n) & (piece_ranks >= 0)
+        piece_ranks = piece_ranks[kept]
+        indexed = order[kept]
+        selected = self.selected_starts[piece_ranks] + indexed - self.mode["note_starts"][self.numbers[piece_ranks]]
+        return group_ids, group_ids[kept], selected
+
+    def _group_of(self, ngram, group_ids):
+        """Group id of an n-gram in the suffix order, or None if it does not occur in the index"""
+        order, codes, valid_lengths = self.scale["order"], self.scale["codes"], self.scale["valid_lengths"]
+        target = tuple(ngram)
+
+        class Prefixes:
+            def __len__(self):
+                return len(order)
+
+            def __getitem__(self, rank):
+                position = order[rank]
+                length = min(valid_lengths[position], len(target))
+                return tuple(codes[position:position + length].tolist()) + (REST,) * (len(target) - length)
+
+        rank = bisect_left(Prefixes(), target)
+        if rank < len(order) and Prefixes()[rank] == target:
+            return group_ids[rank]
+        return None
+
+    def _junction_postings(self, group_ids):
+        """Group and selected position of every valid window spanning two selected pieces"""
+        junctions = self.selected_starts[1:-1] - 1
+        starts = np.unique((junctions[:, None] - np.arange(self.n)[None, :]).reshape(-1))
+        # into_patterns never starts a window at the last n intervals
+        starts = starts[(starts >= 0) & (starts <= self.total - 2 - self.n)]
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64), starts
+        ngrams = self._selected_codes(starts[:, None] + np.arange(self.n)[None, :])
+        valid = (ngrams != REST).all(axis=1)
+        starts, ngrams = starts[valid], ngrams[valid]
+
+        new_groups = {}
+        groups = np.empty(len(starts), dtype=np.int64)
+        for i, ngram in enumerate(map(tuple, ngrams.tolist())):
+            group = self._group_of(ngram, group_ids)
+            if group is None:
+                group = new_groups.setdefault(ngram, len(group_ids) + len(new_groups))
+            groups[i] = group
+        return groups, starts
+
+    def matches(self, minimum_match):
+        group_ids, groups, selected = self._indexed_postings()
+        # into_patterns never starts a window at the last n intervals
+        kept = selected <= self.total - 2 - self.n
+        groups, selected = groups[kept], selected[kept]
+        junction_groups, junction_starts = self._junction_postings(group_ids)
+        groups = np.concatenate((groups, junction_groups))
+        selected = np.concatenate((selected, junction_starts))
+
+        counts = np.bincount(groups, minlength=len(group_ids) + len(junction_groups))
+        kept = counts[groups] > minimum_match
+        groups, selected = groups[kept], selected[kept]
+        if len(groups) == 0:
+            return pd.DataFrame([])
+
+        # find_exact_matches lists patterns by first occurrence, each with its
+        # matches in the order of the corpus
+        first = np.full(len(counts), self.total)
+        np.minimum.at(first, groups, selected)
+        sorting = np.lexsort((selected, first[groups]))
+        return self._frame(selected[sorting])
+
+    def _frame(self, starts):
+        n = self.n
+        notes = self.mode["notes"]
+        patterns = self._selected_codes(starts[:, None] + np.arange(n)[None, :]).tolist()
+        window_notes, ranks = self._indexed_positions(starts[:, None] + np.arange(n + 1)[None, :])
+        first_notes, last_notes = window_notes[:, 0], window_notes[:, -1]
+        durations = notes["duration"][window_notes].tolist()
+
+        start_measures = notes["measure"][first_notes].tolist()
+        end_measures = notes["measure"][last_notes].tolist()
+        start_beats = notes["beat"][first_notes].tolist()
+        end_beats = notes["beat"][last_notes].tolist()
+        part_numbers = notes["part_number"][first_notes].tolist()
+        emas = []
+        for start_measure, end_measure, part_number, start_beat, end_beat in zip(start_measures, end_measures, part_numbers, start_beats, end_beats):
+            # as in crim_intervals.Match
+            emas.append(
+                str(start_measure) + "-" + str(end_measure) + "/" + str(part_number) + "/"
+                + "@" + str(start_beat) + "-end"
+                + ",@start-end" * (end_measure - start_measure - 1)
+                + ",@start-" + str(end_beat)
+            )
+        ema_urls = []
+        for rank, ema in zip(ranks[:, 0].tolist(), emas):
+            path = self.paths[rank]
+            if "mei/" in path:
+                ema_urls.append("https://ema.crimproject.org/https%3A%2F%2Fcrimproject.org%2Fmei%2F" + path[path.index("mei/") + 4:] + "/" + ema)
+            else:
+                ema_urls.append("File must be a crim url to have a valid EMA url")
+
+        titles = self.mode["titles"]
+        return pd.DataFrame({
+            "pattern_generating_match": patterns,
+            "pattern_matched": patterns,
+            "piece_title": [titles[number] for number in self.numbers[ranks[:, 0]].tolist()],
+            "part": notes["part"][first_notes].tolist(),
+            "start_measure": start_measures,
+            "start_beat": start_beats,
+            "end_measure": end_measures,
+            "end_beat": end_beats,
+            "start_offset": notes["offset"][first_notes].tolist(),
+            "end_offset": notes["offset"][last_notes].tolist(),
+            "note_durations": durations,
+            "ema": emas,
+            "ema_url": ema_urls,
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the interval index used by exact searches in the app.")
+    parser.add_argument("mei_dir", nargs="?", default=str(Path(__file__).resolve().parent / "mei"), help="directory of MEI files to index")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR), help="cache directory, as $CRIM_CACHE_DIR in the app")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, as $CRIM_LOAD_WORKERS")
+    args = parser.parse_args()
+
+    paths = sorted(str(path) for path in Path(args.mei_dir).resolve().glob("*.mei"))
+    indexed = build_index(paths, args.cache_dir, args.workers)
+    print("Indexed {} of {} pieces into {}".format(indexed, len(paths), index_dir(args.cache_dir)))
+
+
+if __name__ == "__main__":
+    main()
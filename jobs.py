@@ -0,0 +1,226 @@
+"""
+Long searches as background jobs, with progress, cancellation and time budgets.
+
+Close searches, the classifier and parameter comparisons can run for minutes
+on large selections,
+longer than the platform lets a request take.  The app submits them to a
+JobManager, whose worker threads run them while the script shows their
+progress and polls until they finish.
+
+A job's function is called with the Job as its first argument.  It reports
+its progress with job.progress(), and checks job.stopping() between units of
+work: once the job is cancelled or out of its time budget, the function
+returns what it has so far and sets job.partial.
+
+A job can be given a context, a function returning a context manager the
+function runs in, e.g. IntervalPrecomputer.searching; the job counts as
+queued until it is entered.
+
+The function runs in a worker thread, where the script's RunTimings and
+SearchProfile do not see it, so each job has its own: the function times its
+stages in job.timings, and is profiled in job.profile if asked for.  The app
+adds both to those of the run that takes the result.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from crim_intervals import classify_matches
+
+from close_matches import find_close_matches_indexed
+from instrumentation import RunTimings
+from profiling import SearchProfile
+from sweep import sweep_corpus
+
+# default time budget of a search, in seconds, 0 for none
+SEARCH_BUDGET = float(os.environ.get("CRIM_SEARCH_BUDGET", 0))
+
+# patterns classified between two checks of job.stopping()
+CLASSIFY_CHUNK = 25
+
+# seconds after which a job nobody asked for is taken to be abandoned, e.g.
+# by a session that was closed while polling for it
+ABANDON_SECONDS = 120
+
+
+class JobPending(Exception):
+    """Raised by the app while the job a result waits for is running"""
+    def __init__(self, job):
+        super().__init__(job.description)
+        self.job = job
+
+
+class Job:
+    """
+    One function run in the background.
+
+    description (str): what the job does, e.g. for a progress bar
+    unit (str): what its progress is counted in, e.g. "patterns"
+    budget (float): seconds after which the job is to stop, or None
+    profile (bool): whether to profile the function, in self.profile
+    done, total (int): units of work done, and to do if known
+    partial (bool): whether the function stopped before the end
+    result: what the function returned, once finished
+    error (Exception): what the function raised, if it did
+    timings (RunTimings): the stages timed by the function
+    started (float): when a worker started the function, None while queued
+    """
+    def __init__(self, description, unit, budget=None, profile=False):
+        self.description = description
+        self.unit = unit
+        self.budget = budget
+        self.profile = SearchProfile(profile)
+        self.timings = RunTimings()
+        self.started = None
+        self.asked = time.time()
+        self.done = 0
+        self.total = None
+        self.partial = False
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    def progress(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def elapsed(self):
+        """Seconds the function has run, 0 while the job is queued"""
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    def over_budget(self):
+        return self.budget is not None and self.elapsed() > self.budget
+
+    def stopping(self):
+        """Whether the function should return what it has so far"""
+        return self.cancelled() or self.over_budget()
+
+    def finished(self):
+        return self._finished.is_set()
+
+    def fraction(self):
+        """Share of the work done, from 0 to 1"""
+        if not self.total:
+            return 0.0
+        return min(1.0, self.done / self.total)
+
+    def status(self):
+        """e.g. "1,200 of 5,000 patterns, 12 s", or "queued" until a worker starts it"""
+        if self.started is None:
+            return "{}: queued".format(self.description)
+        done = "{:,} of {:,} {}".format(self.done, self.total, self.unit) if self.total else "starting"
+        return "{}: {}, {:.0f} s".format(self.description, done, self.elapsed())
+
+    def partial_note(self):
+        """Why the result is partial"""
+        reason = "cancelled" if self.cancelled() else "stopped after its time budget of {:g} s".format(self.budget)
+        return "Partial results: the {} was {}, having gone through {:,} of {:,} {}.".format(
+            self.description.lower(), reason, self.done, self.total or 0, self.unit)
+
+
+class JobManager:
+    """
+    Runs jobs in a pool of worker threads, finding them again by key.
+
+    A job stays with its manager until its result is taken with pop(), or it
+    is dropped with discard(), so a script that polls for it gets it whichever
+    run of the script it ends in.  Jobs not asked for through submit() in
+    abandon_after seconds are cancelled and dropped too.
+    """
+    def __init__(self, workers=2, abandon_after=ABANDON_SECONDS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.abandon_after = abandon_after
+
+    def submit(self, key, description, unit, function, *args, budget=None, profile=False, context=None):
+        """
+        The job under key, submitting function(job, *args) as one if there is
+        none, run in the with block of context() if given
+        """
+        with self._lock:
+            self._drop_abandoned()
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = Job(description, unit, budget, profile)
+                self._executor.submit(self._run, job, function, args, context or nullcontext)
+            job.asked = time.time()
+            return job
+
+    def _drop_abandoned(self):
+        now = time.time()
+        for key, job in list(self._jobs.items()):
+            if now - job.asked > self.abandon_after:
+                job.cancel()
+                del self._jobs[key]
+
+    def _run(self, job, function, args, context):
+        try:
+            with context():
+                # the time budget counts from here, not from the time spent queued
+                job.started = time.time()
+                with job.profile.capture():
+                    job.result = function(job, *args)
+        except Exception as e:
+            job.error = e
+        finally:
+            job._finished.set()
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def pop(self, key):
+        with self._lock:
+            return self._jobs.pop(key, None)
+
+    def discard(self, key):
+        """Cancels and drops the job under key, if there is one"""
+        job = self.pop(key)
+        if job is not None:
+            job.cancel()
+
+
+# job functions
+
+def close_matches_job(job, patterns_data, min_matches, threshold):
+    """find_close_matches_indexed as a job, reporting the patterns gone through"""
+    with job.timings.stage("matching"):
+        return find_close_matches_indexed(patterns_data, min_matches, threshold, job=job)
+
+
+def classify_job(job, matches, durations_threshold):
+    """
+    classify_matches as a job, classifying CLASSIFY_CHUNK patterns at a time.
+
+    classify_matches classifies the matches of each pattern on their own, so
+    the chunks together give the same result.
+    """
+    classified = []
+    job.progress(0, len(matches))
+    for start in range(0, len(matches), CLASSIFY_CHUNK):
+        if job.stopping():
+            job.partial = True
+            break
+        with job.timings.stage("classify"):
+            classified += classify_matches(matches[start:start + CLASSIFY_CHUNK], durations_threshold)
+        job.progress(min(start + CLASSIFY_CHUNK, len(matches)))
+    return classified
+
+
+def sweep_job(job, corpus, durations, scales, vector_lengths, minimum_matches, close_distances, intervals):
+    """sweep.sweep_corpus as a job, reporting the (duration, scale, vector length) units counted"""
+    with job.timings.stage("sweep"):
+        return sweep_corpus(corpus, durations, scales, vector_lengths, minimum_matches, close_distances, intervals, job=job)
@@ -0,0 +1,230 @@
+"""
+A memory-bounded LRU cache shared by everything the app keeps between reruns.
+
+st.cache keeps every distinct input forever, which on a shared deployment
+grows until the dyno is killed.  LRUCache instead holds at most max_bytes of
+(estimated) memory and evicts the least recently used entries beyond that.
+
+Entries can be pinned by an owner (a session, say) for as long as the owner
+is alive: pinned entries still count towards the budget but are never evicted,
+since whoever pinned them keeps them in memory anyway.  Pinning the pieces of
+the selection being searched keeps a selection larger than the budget from
+evicting its own pieces, and loading them again on every rerun.
+
+The search results each session keeps go in the same cache, through a
+CacheView, so that the budget bounds them too whatever the number of sessions.
+
+Sizes are estimates.  Objects that share structure (the note lists of a
+selection reference the music21 scores of its pieces) are charged to the
+entry that created the shared structure, and every other entry is charged
+only for what it adds.
+"""
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+import pandas as pd
+
+DEFAULT_MAX_BYTES = int(os.environ.get("CRIM_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+
+# Approximate sizes, measured with tracemalloc over the pieces in mei/.
+# A parsed piece (its music21 score and note lists) per note of its note_list:
+PIECE_BYTES_PER_NOTE = 8000
+# A VectorInterval in both IntervalBase.generic_intervals and semitone_intervals:
+INTERVAL_BYTES = 210
+# A NoteListElement built by one of the CorpusBase.note_list_* methods:
+NOTE_BYTES = 400
+# A Match object returned by find_exact_matches or find_close_matches:
+MATCH_BYTES = 800
+
+
+def estimate_size(value):
+    """
+    Estimates the memory held by a cached value, in bytes.
+
+    Understands DataFrames, single-piece corpora (CorpusBase), IntervalBase
+    objects, lists of PatternMatches and tuples of these; anything else is
+    measured with sys.getsizeof.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if hasattr(value, "scores") and hasattr(value, "note_list"):
+        if len(value.scores) == 1:
+            return len(value.note_list) * PIECE_BYTES_PER_NOTE
+        # a corpus assembled from cached pieces only adds its own lists
+        return 16 * (len(value.note_list) + len(value.no_unisons))
+    if hasattr(value, "generic_intervals"):
+        # note lists sampled from the scores belong to the IntervalBase built on them
+        return len(value.generic_intervals) * INTERVAL_BYTES + len(value.notes) * NOTE_BYTES
+    if isinstance(value, list) and value and hasattr(value[0], "matches"):
+        return sys.getsizeof(value) + sum(len(pattern_matches.matches) for pattern_matches in value) * MATCH_BYTES
+    return sys.getsizeof(value)
+
+
+class CacheOwner:
+    """Stands for a session (or anything else) that pins entries, see LRUCache.pin"""
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by the estimated size of its values.
+
+    Safe to share between the threads of concurrent Streamlit sessions.
+
+    max_bytes (int): memory budget, or None for no limit
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # owner -> {group: keys it pins}, dropped along with the owner
+        self._pins = weakref.WeakKeyDictionary()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Returns the value cached under key, counting a hit or a miss"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes=None):
+        """
+        Caches value under key, then evicts least recently used entries until
+        the cache is back within its budget.  A value larger than the whole
+        budget is not cached at all.
+
+        nbytes (int): size of value, estimated with estimate_size if omitted
+        """
+        if nbytes is None:
+            nbytes = estimate_size(value)
+        with self._lock:
+            self.pop(key)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            self._evict()
+
+    def _evict(self):
+        # least recently used first, skipping pinned entries
+        if self.max_bytes is None or self.size <= self.max_bytes:
+            return
+        pinned = self._pinned()
+        for key in list(self._entries):
+            if self.size <= self.max_bytes:
+                break
+            if key in pinned:
+                continue
+            _, evicted_bytes = self._entries.pop(key)
+            self.size -= evicted_bytes
+            self.evictions += 1
+
+    def pin(self, owner, keys, group=None):
+        """
+        Keeps the entries under keys, present or put later, from being evicted
+        for as long as owner is alive, replacing what owner pinned before in
+        the same group.
+
+        owner: any object that can be weakly referenced, e.g. a CacheOwner
+        group: what the keys are pinned for, e.g. "pieces", so that an owner
+            can pin several sets of keys independently
+        """
+        with self._lock:
+            self._pins.setdefault(owner, {})[group] = frozenset(keys)
+            self._evict()
+
+    def _pinned(self):
+        return set().union(*(keys for groups in self._pins.values() for keys in groups.values()))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, nbytes = self._entries.pop(key)
+            self.size -= nbytes
+            return value
+
+    def get_or_compute(self, key, compute, nbytes=None):
+        """Returns the value cached under key, computing and caching it on a miss"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value, nbytes)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Current size, budget and hit/miss counts, e.g. for display in the app"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "pinned": len(self._pinned() & set(self._entries)),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# the cache of this process, when it runs units of work for crim_batch or sweep
+_worker_cache = None
+
+
+def worker_cache():
+    """The LRUCache a worker process keeps between the units of work it runs"""
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = LRUCache()
+    return _worker_cache
+
+
+class CacheView:
+    """
+    The entries of an LRUCache whose keys start with prefix, e.g. the search
+    results of one session, addressed without the prefix.
+
+    cache (LRUCache): cache the entries are kept in, and charged to
+    prefix (tuple): start of their keys in cache
+    """
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        return self.cache.get(self.prefix + key, default)
+
+    def put(self, key, value, nbytes=None):
+        self.cache.put(self.prefix + key, value, nbytes)
+
+    def pop(self, key, default=None):
+        return self.cache.pop(self.prefix + key, default)
+
+    def size(self):
+        """Estimated bytes of the entries in the view"""
+        with self.cache._lock:
+            return sum(nbytes for key, (_, nbytes) in self.cache._entries.items() if key[:len(self.prefix)] == self.prefix)
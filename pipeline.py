@@ -0,0 +1,304 @@
+"""
+The search pipeline behind the app, from a loaded corpus to matches.
+
+The steps the sidebar walks through (duration mode, interval scale, vector
+length, ...) are plain functions here so that their results can be cached in
+the app's LRUCache and reused by scripts that run without Streamlit.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from crim_intervals import IntervalBase, PatternMatches
+
+from memory_cache import INTERVAL_BYTES, NOTE_BYTES
+from ratio_distances import RaggedArray, get_ratio_distances, get_ratios
+
+# Step 2: which note list of the corpus the intervals are built from
+DURATION_CHOICES = ["Actual", "Incremental@1", "Incremental@2", "Incremental@4"]
+
+# Step 3: which IntervalBase view the patterns are built from
+SCALE_CHOICES = ["Diatonic", "Chromatic"]
+
+# the columns of the export_pandas table of the matches, which has none when
+# there are no matches
+MATCH_COLUMNS = ["pattern_generating_match", "pattern_matched", "piece_title", "part", "start_measure", "start_beat",
+                 "end_measure", "end_beat", "start_offset", "end_offset", "note_durations", "ema", "ema_url"]
+
+# the sidebar parameters each stage of a search depends on, through the stages
+# before it or directly; results cached under stage_key() are reused for as
+# long as none of these change, whatever else does
+_MATCHES = ("selection", "duration", "scale", "vector_length", "minimum_match")
+STAGE_PARAMETERS = {
+    "corpus": ("selection",),
+    "intervals": ("selection", "duration"),
+    "patterns": ("selection", "duration", "scale", "vector_length"),
+    "exact_matches": _MATCHES,
+    "close_matches": _MATCHES + ("close_distance",),
+    "exact_durations": _MATCHES + ("max_sum_diffs",),
+    "close_durations": _MATCHES + ("close_distance", "max_sum_diffs"),
+    "exact_classified": _MATCHES + ("max_sum_diffs_classify",),
+    "close_classified": _MATCHES + ("close_distance", "max_sum_diffs_classify"),
+}
+
+
+def stage_key(stage, params):
+    """Cache key of the result of stage, from a dict of the sidebar parameters"""
+    return (stage,) + tuple(params[name] for name in STAGE_PARAMETERS[stage])
+
+
+# thresholds whose results only grow as the threshold widens, so the result for
+# a threshold can be filtered from the result for any wider one; 1 if wider is
+# higher, -1 if wider is lower
+MONOTONE_THRESHOLDS = {"minimum_match": -1, "close_distance": 1, "max_sum_diffs": 1}
+
+
+def covers(bounds, thresholds):
+    """Whether a result computed with the thresholds bounds contains the result for thresholds"""
+    return all((bounds[name] - value) * MONOTONE_THRESHOLDS[name] >= 0 for name, value in thresholds.items())
+
+
+def note_list(corpus, duration_choice):
+    """Returns the note list of the corpus for one of DURATION_CHOICES"""
+    if duration_choice == "Actual":
+        return corpus.note_list
+    if duration_choice.startswith("Incremental@"):
+        return corpus.note_list_incremental_offset(int(duration_choice.split("@")[1]))
+    raise ValueError("Unknown duration choice: " + str(duration_choice))
+
+
+def interval_base(corpus, duration_choice, cache=None):
+    """
+    Returns the IntervalBase of the corpus for one of DURATION_CHOICES.
+
+    IntervalBase computes both its generic and semitone intervals up front, so
+    once cached, switching durations or scales is a lookup.
+
+    cache (LRUCache): cache to reuse IntervalBase objects from, keyed by the
+        corpus' cache_key (see corpus_loading.assemble_corpus)
+    """
+    if cache is None:
+        return IntervalBase(note_list(corpus, duration_choice))
+
+    key = ("intervals", corpus.cache_key, duration_choice)
+    vectors = cache.get(key)
+    if vectors is None:
+        vectors = IntervalBase(note_list(corpus, duration_choice))
+        nbytes = len(vectors.generic_intervals) * INTERVAL_BYTES
+        if duration_choice != "Actual":
+            # incremental note lists are built for this IntervalBase alone
+            nbytes += len(vectors.notes) * NOTE_BYTES
+        cache.put(key, vectors, nbytes)
+    return vectors
+
+
+# duration modes in the order they are precomputed, cheapest first
+PRECOMPUTE_ORDER = ["Actual", "Incremental@4", "Incremental@2", "Incremental@1"]
+
+
+class IntervalPrecomputer:
+    """
+    Computes the IntervalBase of a corpus in every duration mode, in a
+    background thread, once one of them has been asked for.
+
+    IntervalBase computes both scales at once, so this covers every (duration,
+    scale) combination of the sidebar.  The scores of a corpus are not safe to
+    read from two threads at once, so one mode is computed at a time: asking
+    for a mode waits at most for the mode being computed in the background to
+    finish, and is then computed before the modes still queued.
+
+    Only the corpus asked for last is precomputed: a selection that has
+    changed since (each piece added to the multiselect makes a new corpus) is
+    dropped before its next mode, and modes are computed in PRECOMPUTE_ORDER,
+    so the slow Incremental@1 comes last.
+
+    Building matches (Match, export_pandas, classify_matches) reads the note
+    contexts that computing an interval base changes, so searches run in
+    searching() blocks, during which no interval base is computed.
+
+    cache (LRUCache): cache the interval bases are kept in, see interval_base;
+        precomputing stops once it is more than max_fill full, so that it does
+        not evict what is in use
+    """
+    def __init__(self, cache, max_fill=0.5):
+        self.cache = cache
+        self.max_fill = max_fill
+        self._turns = threading.Condition()
+        self._busy = False
+        self._waiting = 0
+        self._searches = 0
+        # the corpus asked for last, and whether the worker is on its way to it
+        self._current = None
+        self._scheduled = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="interval-precompute")
+
+    @contextmanager
+    def _turn(self, asked):
+        # one mode at a time, modes asked for before precomputed ones, and
+        # none while a search runs
+        with self._turns:
+            if asked:
+                self._waiting += 1
+            self._turns.wait_for(lambda: not self._busy and not self._searches and (asked or not self._waiting))
+            if asked:
+                self._waiting -= 1
+            self._busy = True
+        try:
+            yield
+        finally:
+            with self._turns:
+                self._busy = False
+                self._turns.notify_all()
+
+    @contextmanager
+    def searching(self):
+        """
+        Holds off computing interval bases while the with block builds
+        matches.  Searches run alongside each other; a mode asked for waits
+        for those running, and searches started after it wait for it.  The
+        block must not ask for an interval base itself.
+        """
+        with self._turns:
+            self._turns.wait_for(lambda: not self._busy and not self._waiting)
+            self._searches += 1
+        try:
+            yield
+        finally:
+            with self._turns:
+                self._searches -= 1
+                self._turns.notify_all()
+
+    def interval_base(self, corpus, duration_choice):
+        """Same as interval_base(corpus, duration_choice, cache), then queues the other modes"""
+        with self._turn(asked=True):
+            vectors = interval_base(corpus, duration_choice, self.cache)
+        self.precompute(corpus)
+        return vectors
+
+    def precompute(self, corpus):
+        """Queues the duration modes of corpus not computed yet, in place of any corpus queued before"""
+        with self._turns:
+            if self._current is not None and self._current.cache_key == corpus.cache_key:
+                return
+            self._current = corpus
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._executor.submit(self._precompute)
+
+    def _full(self):
+        return self.cache.max_bytes is not None and self.cache.size > self.max_fill * self.cache.max_bytes
+
+    def _precompute(self):
+        corpus = None
+        try:
+            while True:
+                with self._turns:
+                    if self._current is corpus:
+                        self._scheduled = False
+                        return
+                    corpus = self._current
+                for duration_choice in PRECOMPUTE_ORDER:
+                    if self._full():
+                        break
+                    with self._turn(asked=False):
+                        # the selection may have changed while waiting for the turn
+                        if self._current is not corpus:
+                            break
+                        interval_base(corpus, duration_choice, self.cache)
+        except Exception as e:
+            print("Could not precompute intervals: " + str(e))
+            with self._turns:
+                self._scheduled = False
+
+
+def scale_intervals(vectors, scale_choice):
+    """Returns the generic or semitone intervals of an IntervalBase for one of SCALE_CHOICES"""
+    if scale_choice == "Diatonic":
+        return vectors.generic_intervals
+    if scale_choice == "Chromatic":
+        return vectors.semitone_intervals
+    raise ValueError("Unknown scale choice: " + str(scale_choice))
+
+
+def filter_matches(matches, minimum_match):
+    """
+    The PatternMatches of an exact or close search with a lower minimum of
+    matches that the same search with minimum_match would return, in order.
+    """
+    return [pattern_matches for pattern_matches in matches if len(pattern_matches.matches) > minimum_match]
+
+
+def filter_results(results, minimum_match):
+    """Same as filter_matches, for the export_pandas table of the matches"""
+    if len(results) == 0:
+        return results
+    patterns = results["pattern_generating_match"].map(tuple)
+    sizes = patterns.groupby(patterns, sort=False).transform("size")
+    return results[sizes > minimum_match].reset_index(drop=True)
+
+
+def filter_close_matches(matches, close_distance, minimum_match):
+    """
+    The result of a close search with close_distance and minimum_match, from
+    its result for a close_distance at least as wide and a minimum_match at
+    most as high: every pattern kept then had all its windows within
+    close_distance.
+    """
+    filtered = []
+    for pattern_matches in matches:
+        pattern = pattern_matches.pattern
+        close = [match for match in pattern_matches.matches if sum(abs(a - b) for a, b in zip(pattern, match.pattern)) <= close_distance]
+        if len(close) > minimum_match:
+            filtered.append(PatternMatches(pattern, close))
+    return filtered
+
+
+def filter_close_results(results, close_distance, minimum_match):
+    """Same as filter_close_matches, for the export_pandas table of the matches"""
+    if len(results) == 0:
+        return results
+    generating = np.array(results["pattern_generating_match"].tolist())
+    matched = np.array(results["pattern_matched"].tolist())
+    return filter_results(results[np.abs(generating - matched).sum(axis=1) <= close_distance], minimum_match)
+
+
+def duration_filter(results, max_sum_diffs):
+    """
+    Step 6: adds the duration ratios of each match to results, as a
+    "duration_ratios" column, and returns the pairs of matches of the same
+    pattern whose ratios differ by at most max_sum_diffs in sum (see
+    ratio_distances.get_ratio_distances).
+
+    results (pd.DataFrame): matches, as returned by export_pandas; with no
+        matches it is given the usual columns, so that the pairs are an
+        empty table with theirs
+    """
+    for column in MATCH_COLUMNS:
+        if column not in results:
+            results[column] = pd.Series(dtype=object)
+    # packs the durations of all soggetti into one array, so that the
+    # 'duration ratios' of all of them are calculated at once
+    ratios = get_ratios(RaggedArray.from_lists(results["note_durations"]))
+    # the lists are only needed to display the ratios
+    results["duration_ratios"] = ratios.to_lists()
+    return get_ratio_distances(results, "pattern_generating_match", ["piece_title", "part", "start_measure", "end_measure"], max_sum_diffs=max_sum_diffs, duration_ratios=ratios)
+
+
+def classified_matches_to_pandas(matches):
+    """Step 7: one row per entry of each presentation type found by classify_matches"""
+    soggetti_matches = []
+    for i, cm in enumerate(matches):
+        for j, soggetti in enumerate(cm.matches):
+            soggetti_matches.append({
+                "piece": soggetti.first_note.metadata.title,
+                "type": cm.type,
+                "part": soggetti.first_note.part.strip("[] "),
+                "start_measure": soggetti.first_note.note.measureNumber,
+                "entry_number": j + 1,
+                "pattern": cm.pattern,
+                "match_number": i + 1
+            })
+    return pd.DataFrame(soggetti_matches)
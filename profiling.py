@@ -0,0 +1,97 @@
+"""
+Opt-in profiling of the searches run by the app.
+
+With $CRIM_PROFILE set, or ?profile=1 in the app's URL, the searches started
+by the sidebar buttons run under cProfile, and the profile can be downloaded
+as a .prof file, to be read with pstats, snakeviz and the like.  Profiling
+makes the searches several times slower, so it is off otherwise.
+
+cProfile only sees the thread that enables it, so work done in background
+jobs is profiled there and added to the profile of the search with add().
+Only one profiler can be active in a process at a time (enabling a second
+raises ValueError from Python 3.12), so a block captured while another is
+being profiled, e.g. by another session, runs unprofiled and the profile
+notes that it skipped it.
+"""
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import threading
+from contextlib import contextmanager
+
+PROFILE = bool(os.environ.get("CRIM_PROFILE"))
+
+# held while a profiler is enabled, in whichever thread
+_profiling = threading.Lock()
+
+
+class SearchProfile:
+    """
+    A cProfile of the code run in capture() blocks, if enabled.
+
+    enabled (bool): profile, rather than only run, the blocks
+    captured (bool): whether any block was profiled, here or in a profile added
+    skipped (int): blocks run unprofiled as another profiler was active
+    """
+    def __init__(self, enabled=PROFILE):
+        self.enabled = enabled
+        self.profile = cProfile.Profile() if enabled else None
+        self.captured = False
+        self.skipped = 0
+        # profiles of other threads, see add()
+        self._added = []
+
+    @contextmanager
+    def capture(self):
+        """Profiles the code run in the with block, if enabled"""
+        if not self.enabled:
+            yield
+            return
+        if not _profiling.acquire(blocking=False):
+            self.skipped += 1
+            yield
+            return
+        try:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+                self.captured = True
+        finally:
+            _profiling.release()
+
+    def add(self, other):
+        """Adds what another SearchProfile captured, e.g. in a background job, to this one"""
+        if other.captured:
+            self._added += [other.profile] + other._added
+            self.captured = True
+        self.skipped += other.skipped
+
+    def _stats(self, stream=None):
+        stats = None
+        for profile in [self.profile] + self._added:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile, stream=stream)
+            else:
+                stats.add(profile)
+        return stats
+
+    def prof_bytes(self):
+        """The profile as the file written by cProfile.Profile.dump_stats"""
+        return marshal.dumps(self._stats().stats)
+
+    def top_functions(self, count=30, sort="cumulative"):
+        """The count most expensive functions, as printed by pstats"""
+        out = io.StringIO()
+        if self.skipped:
+            out.write("{} part(s) of the search ran unprofiled, as another profile was being taken.\n".format(self.skipped))
+        stats = self._stats(out)
+        if stats is not None:
+            stats.sort_stats(sort).print_stats(count)
+        return out.getvalue()
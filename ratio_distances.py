@@ -0,0 +1,432 @@
+"""
+Distances between the durational ratios of melodic matches (Step 6 of the app).
+
+Each match of a melodic pattern has a list of note durations, and so a list
+of ratios between consecutive durations.  Matches generated by the same
+pattern are compared pairwise, and the distance of a pair is the sum of the
+absolute differences between their ratios.
+
+Columns of sequences (note durations, ratios, patterns) are handled as
+RaggedArrays, one flat buffer of values plus row offsets, rather than as a
+Python list per row.
+"""
+from itertools import chain, tee
+
+import numpy as np
+import pandas as pd
+
+
+# functions for pairs of ratios
+
+def pairwise(iterable):
+    "s -> (s0,s1), (s1,s2), (s2, s3), ..."
+    a, b = tee(iterable)
+    next(b, None)
+    return zip(a, b)
+
+def get_ratios(input_list):
+    """
+    Ratios between consecutive durations: of one list of durations, or of
+    every row of a RaggedArray at once (see RaggedArray.ratios)
+    """
+    if isinstance(input_list, RaggedArray):
+        return input_list.ratios()
+    ratio_pairs = []
+    for a, b in pairwise(input_list):
+        ratio_pairs.append(b / a)
+    return ratio_pairs
+
+def compare_ratios(ratios_1, ratios_2):
+
+    ## division of lists
+    # using zip() + list comprehension
+    diffs = [i - j for i, j in zip(ratios_1, ratios_2)]
+    abs_diffs = [abs(ele) for ele in diffs]
+    sum_diffs = sum(abs_diffs)
+
+    return sum_diffs
+
+
+class RaggedArray:
+    """
+    Rows of varying length stored as one flat array of values plus offsets, the
+    way Arrow stores list columns: row i is values[offsets[i]:offsets[i + 1]].
+
+    values are float64 when every value is a Python float and int64 when every
+    value is an int; anything else (such as the Fractions music21 uses for some
+    durations) is kept in an object array so its arithmetic stays exact.
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, lists):
+        """Packs a sequence (or Series) of lists or tuples"""
+        lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+        flat = list(chain.from_iterable(lists))
+        value_types = set(map(type, flat))
+        if value_types <= {float}:
+            dtype = float
+        elif value_types <= {int}:
+            dtype = np.int64
+        else:
+            dtype = object
+        values = np.empty(len(flat), dtype=dtype)
+        values[:] = flat
+        return cls(values, np.concatenate(([0], np.cumsum(lengths))))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def ratios(self):
+        """
+        Ratios between consecutive values of every row, as a new RaggedArray:
+        one division over the whole buffer, dropping the quotients that would
+        span two rows.
+        """
+        lengths = self.lengths()
+        spans_rows = np.zeros(max(len(self.values) - 1, 0), dtype=bool)
+        row_ends = self.offsets[1:-1]
+        spans_rows[row_ends[(row_ends > 0) & (row_ends < len(self.values))] - 1] = True
+        values = (self.values[1:] / self.values[:-1])[~spans_rows]
+        offsets = np.concatenate(([0], np.cumsum(np.maximum(lengths - 1, 0))))
+        return RaggedArray(values, offsets)
+
+    def rows(self, positions):
+        """
+        Packs the given rows into a 2-D array, padding shorter rows with NaN.
+        Returns the array and the length of each row.
+        """
+        lengths = self.lengths()[positions]
+        width = int(lengths.max(initial=0))
+        columns = np.arange(width)
+        inside = columns[None, :] < lengths[:, None]
+        if len(self.values) == 0:
+            return np.empty((len(positions), width), dtype=self.values.dtype), lengths
+        matrix = self.values[np.where(inside, self.offsets[positions][:, None] + columns[None, :], 0)]
+        if not inside.all():
+            matrix = matrix.astype(float if matrix.dtype == np.int64 else matrix.dtype)
+            matrix[~inside] = np.nan
+        return matrix, lengths
+
+    def to_lists(self):
+        """Unpacks the rows into Python lists, e.g. for display"""
+        values = self.values.tolist()
+        return [values[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+
+def _sum_diffs(matrix, lengths, first, second):
+    """
+    Distances between the rows first[k] and second[k] of a ratio matrix.
+
+    Columns are accumulated one at a time, in the order compare_ratios sums
+    them, so the results are identical to it, and like zip() each pair only
+    compares as many ratios as the shorter row has.
+    """
+    if matrix.dtype == object:
+        sums = np.zeros(len(first), dtype=object)
+    else:
+        sums = np.zeros(len(first))
+    shortest = np.minimum(lengths[first], lengths[second])
+    for column in range(matrix.shape[1]):
+        compared = column < shortest
+        diffs = abs(matrix[first, column] - matrix[second, column])
+        if compared.all():
+            sums += diffs
+        else:
+            sums[compared] += diffs[compared]
+    return sums
+
+
+# Upper bound on the pairs compared at once, which bounds the memory used for
+# pairs that the threshold rejects.
+BLOCK_PAIRS = 250000
+
+
+def _pair_blocks(group_size, block_pairs):
+    """
+    Yields the pairs (first, second) of itertools.combinations(range(group_size), 2)
+    in blocks of whole rows of about block_pairs pairs, with the position of
+    each pair in the full enumeration.
+    """
+    row_pairs = np.arange(group_size - 1, 0, -1)
+    row_offsets = np.concatenate(([0], np.cumsum(row_pairs)))
+    start = 0
+    while start < group_size - 1:
+        end = int(np.searchsorted(row_offsets, row_offsets[start] + block_pairs, side="right")) - 1
+        end = min(max(end, start + 1), group_size - 1)
+        counts = row_pairs[start:end]
+        first = np.repeat(np.arange(start, end), counts)
+        ordinals = np.arange(row_offsets[start], row_offsets[end])
+        second = ordinals - np.repeat(row_offsets[start:end], counts) + first + 1
+        yield first, second, ordinals
+        start = end
+
+
+# Groups with at least this many matches are searched through a VPTree when a
+# threshold is given; smaller groups are faster to compare exhaustively.
+INDEX_MIN_GROUP = 2000
+
+
+def _l1(points, point):
+    return np.abs(points - point).sum(axis=1)
+
+
+class VPTree:
+    """
+    Vantage-point tree over the rows of a matrix, under the L1 distance.
+
+    Each inner node holds a vantage point and the median distance mu of the
+    other rows to it; rows within mu go to the inner subtree, the others to
+    the outer one.  The triangle inequality then rules out whole subtrees in
+    range queries.
+
+    Distances inside the tree are computed with plain NumPy sums, which may
+    round differently from compare_ratios, so pruning allows for a small slack
+    and pairs_within returns candidates to be checked exactly.
+    """
+    LEAF_SIZE = 64
+
+    def __init__(self, points):
+        self.points = points
+        self.slack = 1e-9 * (1 + 2 * float(np.abs(points).sum(axis=1).max(initial=0)))
+        self.root = self._build(np.arange(len(points)))
+
+    def _build(self, indices):
+        if len(indices) <= self.LEAF_SIZE:
+            return indices
+        vantage_point, others = indices[0], indices[1:]
+        distances = _l1(self.points[others], self.points[vantage_point])
+        mu = float(np.median(distances))
+        inner = distances <= mu
+        if inner.all():
+            return indices
+        return vantage_point, mu, self._build(others[inner]), self._build(others[~inner])
+
+    def pairs_within(self, radius):
+        """
+        Returns arrays (first, second) of candidate pairs of rows, first < second,
+        including every pair at most radius apart.
+
+        All rows are queried at once: each node splits the queries that can
+        still reach its inner or outer subtree, so the work in Python is per
+        node rather than per row.
+        """
+        found_first, found_second = [], []
+        reach = radius + self.slack
+        stack = [(self.root, np.arange(len(self.points)))]
+        while stack:
+            node, queries = stack.pop()
+            if len(queries) == 0:
+                continue
+            if not isinstance(node, tuple):
+                for chunk in np.array_split(queries, -(-len(queries) * len(node) // BLOCK_PAIRS)):
+                    distances = np.abs(self.points[chunk][:, None, :] - self.points[node][None, :, :]).sum(axis=2)
+                    rows, cols = np.nonzero(distances <= reach)
+                    first, second = chunk[rows], node[cols]
+                    keep = first < second
+                    found_first.append(first[keep])
+                    found_second.append(second[keep])
+                continue
+            vantage_point, mu, inner, outer = node
+            distances = _l1(self.points[queries], self.points[vantage_point])
+            near = (distances <= reach) & (queries < vantage_point)
+            found_first.append(queries[near])
+            found_second.append(np.full(near.sum(), vantage_point))
+            stack.append((inner, queries[distances - reach <= mu]))
+            stack.append((outer, queries[distances + reach > mu]))
+        if not found_first:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(found_first), np.concatenate(found_second)
+
+
+def _indexed_pairs(matrix, lengths, max_sum_diffs):
+    """
+    All pairs of a group within max_sum_diffs, found through a VPTree.
+
+    Identical ratio vectors, which are common, are indexed once.  Returns
+    (first, second, sum_diffs) in the order of itertools.combinations, with
+    the same values as comparing every pair.
+    """
+    distinct, inverse = np.unique(matrix, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    distinct_lengths = np.full(len(distinct), lengths[0])
+
+    # candidates from the tree, checked with the exact distance
+    tree_first, tree_second = VPTree(distinct).pairs_within(max_sum_diffs)
+    tree_sums = _sum_diffs(distinct, distinct_lengths, tree_first, tree_second)
+    kept = tree_sums <= max_sum_diffs
+    tree_first, tree_second, tree_sums = tree_first[kept], tree_second[kept], tree_sums[kept]
+
+    # every vector is at distance 0 of its own duplicates
+    own = np.arange(len(distinct))
+    own_sums = _sum_diffs(distinct, distinct_lengths, own, own)
+    kept = own_sums <= max_sum_diffs
+    vector_first = np.concatenate([tree_first, own[kept]])
+    vector_second = np.concatenate([tree_second, own[kept]])
+    vector_sums = np.concatenate([tree_sums, own_sums[kept]])
+
+    # expand pairs of vectors to pairs of the matches having them
+    members = np.argsort(inverse, kind="stable")
+    sizes = np.bincount(inverse, minlength=len(distinct))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    counts = sizes[vector_first] * sizes[vector_second]
+    pair = np.repeat(np.arange(len(vector_first)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    a = members[starts[vector_first[pair]] + offsets // sizes[vector_second[pair]]]
+    b = members[starts[vector_second[pair]] + offsets % sizes[vector_second[pair]]]
+    keep = a != b
+    a, b, pair = a[keep], b[keep], pair[keep]
+    first, second = np.minimum(a, b), np.maximum(a, b)
+    # pairs of duplicates were generated in both orders
+    same_vector = vector_first[pair] == vector_second[pair]
+    keep = ~same_vector | (a < b)
+    first, second, pair = first[keep], second[keep], pair[keep]
+
+    order = np.lexsort((second, first))
+    return first[order], second[order], vector_sums[pair[order]]
+
+
+def _group_pairs(matrix, lengths, max_sum_diffs, block_pairs, index):
+    """
+    Yields (first, second, ordinals, sum_diffs) blocks for the pairs of one
+    group, where ordinals are the positions of the pairs among all the pairs
+    of the group.
+    """
+    group_size = len(matrix)
+    use_index = (
+        max_sum_diffs is not None
+        and matrix.dtype != object
+        and (lengths == lengths[0]).all()
+        and (index is True or (index == "auto" and group_size >= INDEX_MIN_GROUP))
+    )
+    if use_index:
+        first, second, sum_diffs = _indexed_pairs(matrix, lengths, max_sum_diffs)
+        ordinals = first * group_size - first * (first + 1) // 2 + (second - first - 1)
+        for start in range(0, len(first), block_pairs):
+            block = slice(start, start + block_pairs)
+            yield first[block], second[block], ordinals[block], sum_diffs[block]
+        return
+
+    for first, second, ordinals in _pair_blocks(group_size, block_pairs):
+        sum_diffs = _sum_diffs(matrix, lengths, first, second)
+        if max_sum_diffs is not None:
+            kept = sum_diffs <= max_sum_diffs
+            first, second, ordinals, sum_diffs = first[kept], second[kept], ordinals[kept], sum_diffs[kept]
+        if len(first):
+            yield first, second, ordinals, sum_diffs
+
+
+def _pattern_groups(patterns):
+    """
+    Groups rows by pattern like groupby() on a column of tuples would, without
+    making a tuple per row.  Returns the patterns, as tuples in sorted order,
+    and the positions of the rows of each.
+    """
+    packed = RaggedArray.from_lists(patterns)
+    lengths = packed.lengths()
+    if packed.values.dtype == np.int64 and len(lengths) and (lengths == lengths[0]).all():
+        # rows of the same length sort like tuples of their values
+        distinct, codes = np.unique(packed.values.reshape(len(lengths), -1), axis=0, return_inverse=True)
+        names = [tuple(row) for row in distinct.tolist()]
+    else:
+        codes, names = pd.factorize(pd.Series([tuple(pattern) for pattern in patterns], dtype=object), sort=True)
+    codes = codes.reshape(-1)
+    rows = np.argsort(codes, kind="stable")
+    return list(names), np.split(rows, np.cumsum(np.bincount(codes, minlength=len(names)))[:-1])
+
+
+def _ratio_distance_blocks(results, pattern_col, output_cols, max_sum_diffs, block_pairs, index, duration_ratios):
+    """
+    Yields (columns, index) for each block of compared pairs with any pair left,
+    where columns maps output column names to arrays, and index holds the
+    position of each pair in the unfiltered output.
+    """
+    output_values = {col: results[col].to_numpy() for col in output_cols}
+    if duration_ratios is None:
+        duration_ratios = RaggedArray.from_lists(results["duration_ratios"])
+
+    pairs_before = 0
+    for name, positions in zip(*_pattern_groups(results[pattern_col])):
+        if len(positions) < 2:
+            continue
+        matrix, lengths = duration_ratios.rows(positions)
+
+        for first, second, ordinals, sum_diffs in _group_pairs(matrix, lengths, max_sum_diffs, block_pairs, index):
+            names = np.empty(len(first), dtype=object)
+            names.fill(name)
+            block = {"pattern": names, "sum_diffs": sum_diffs}
+            for col in output_cols:
+                values = output_values[col][positions]
+                block[f"match_1_{col}"] = values[first]
+                block[f"match_2_{col}"] = values[second]
+            yield block, pairs_before + ordinals
+        pairs_before += len(positions) * (len(positions) - 1) // 2
+
+
+def _frame(blocks, output_cols):
+    columns = ["pattern", "sum_diffs"]
+    for col in output_cols:
+        columns += [f"match_1_{col}", f"match_2_{col}"]
+    if not blocks:
+        return pd.DataFrame(columns=columns, index=pd.Index([], dtype=np.int64))
+    data = {col: _as_column(np.concatenate([block[col] for block, _ in blocks])) for col in columns}
+    return pd.DataFrame(data, columns=columns, index=np.concatenate([index for _, index in blocks]))
+
+
+def iter_ratio_distances(results, pattern_col, output_cols, max_sum_diffs=None, block_pairs=BLOCK_PAIRS, index="auto", duration_ratios=None):
+    """
+    Streams the output of get_ratio_distances as a series of DataFrames.
+
+    About block_pairs pairs are compared at a time, and pairs farther apart
+    than max_sum_diffs are dropped as soon as their distance is known, so only
+    the pairs that are kept take up memory.  Each pair keeps its position in
+    the unfiltered output as its index.
+    """
+    for block in _ratio_distance_blocks(results, pattern_col, output_cols, max_sum_diffs, block_pairs, index, duration_ratios):
+        yield _frame([block], output_cols)
+
+
+def get_ratio_distances(results, pattern_col, output_cols, max_sum_diffs=None, block_pairs=BLOCK_PAIRS, index="auto", duration_ratios=None):
+    """
+    Computes the distance between the duration ratios of every pair of matches
+    generated by the same pattern.
+
+    Pairs are taken group by group, in the order results.groupby(pattern_col)
+    would give if the patterns were tuples, and within a group in the order of
+    itertools.combinations.  For each of
+    output_cols, the values of both matches are copied to match_1_<col> and
+    match_2_<col>.
+
+    With max_sum_diffs, only pairs whose sum_diffs is at most max_sum_diffs are
+    returned, with the index they would have in the unfiltered output, so the
+    result is the same as filtering that output on sum_diffs <= max_sum_diffs.
+    The unfiltered output is never built, though.
+
+    results (pd.DataFrame): matches, with a "duration_ratios" column of lists
+        unless duration_ratios is given
+    pattern_col (str): column of patterns (lists or tuples) to group the matches by
+    output_cols (list): columns of results to copy to the output
+    max_sum_diffs (float): largest distance returned, or None for all pairs
+    block_pairs (int): number of pairs compared at once
+    index (bool or "auto"): whether to find the pairs within max_sum_diffs
+        through a VPTree of each group instead of comparing every pair; "auto"
+        does so for groups of at least INDEX_MIN_GROUP matches
+    duration_ratios (RaggedArray): ratios of each row of results
+    """
+    blocks = list(_ratio_distance_blocks(results, pattern_col, output_cols, max_sum_diffs, block_pairs, index, duration_ratios))
+    if max_sum_diffs is None:
+        if not blocks:
+            return pd.DataFrame([])
+        return _frame(blocks, output_cols).reset_index(drop=True)
+    return _frame(blocks, output_cols)
+
+
+def _as_column(values):
+    # object arrays go through a list so that pandas infers their dtype the
+    # same way it does for rows of dicts
+    return values.tolist() if values.dtype == object else values
@@ -0,0 +1,120 @@
+"""
+Sweeps of the search parameters: how many patterns and matches every
+combination of duration mode, scale, vector length, minimum of matches and
+close distance finds in a selection of pieces.
+
+Interval bases and patterns are built once per (duration, scale, vector
+length), and all the minimums and close distances of the grid are counted on
+those patterns at once (see close_matches.match_counts), without building the
+matches themselves.  The result is one table, with a row per grid point and
+the time taken to build and count the patterns it was counted on.
+
+run_sweep loads the pieces and runs the (duration, scale, vector length)
+units in a pool of worker processes, for the command line; sweep_corpus runs
+them one after another over a corpus already loaded, reusing its interval
+bases, for the app, which runs it as a background job (see jobs.py).
+"""
+
+import pandas as pd
+from crim_intervals import into_patterns
+
+from close_matches import match_counts
+from corpus_loading import DEFAULT_CACHE_DIR, default_workers, load_corpus, process_pool
+from instrumentation import RunTimings
+from memory_cache import worker_cache
+from pipeline import interval_base, scale_intervals
+
+SWEEP_COLUMNS = [
+    "duration", "scale", "vector_length", "search", "minimum_match", "close_distance", "patterns", "matches",
+    "load_seconds", "intervals_seconds", "patterns_seconds", "counting_seconds",
+]
+
+def _unit_rows(vectors, duration_choice, scale_choice, vector_length, minimum_matches, close_distances, timings):
+    # the rows of one unit, from its interval base
+    with timings.stage("patterns"):
+        patterns = into_patterns([scale_intervals(vectors, scale_choice)], vector_length)
+    with timings.stage("counting"):
+        counts = match_counts(patterns, minimum_matches, close_distances)
+    seconds = {stage["stage"] + "_seconds": stage["seconds"] for stage in timings.stages}
+    return [dict(counted, duration=duration_choice, scale=scale_choice, vector_length=vector_length, **seconds) for counted in counts]
+
+
+def _units(durations, scales, vector_lengths):
+    # units of a duration mode come together, so that its interval base is
+    # mostly reused from one to the next
+    return [(duration_choice, scale_choice, vector_length) for duration_choice in durations for scale_choice in scales for vector_length in vector_lengths]
+
+
+def _sweep_table(rows):
+    # close distances of exact searches are missing, not NaN
+    return pd.DataFrame(rows, columns=SWEEP_COLUMNS).astype({"close_distance": "Int64"})
+
+
+def sweep_unit(paths, duration_choice, scale_choice, vector_length, minimum_matches, close_distances, cache_dir=DEFAULT_CACHE_DIR, cache=None):
+    """
+    The rows of the sweep for one (duration, scale, vector length).
+
+    cache (LRUCache): cache of pieces and interval bases, see load_corpus and
+        interval_base; each worker process keeps its own by default
+    """
+    if cache is None:
+        cache = worker_cache()
+    timings = RunTimings()
+    with timings.stage("load"):
+        corpus = load_corpus(paths, cache_dir, workers=1, cache=cache)
+    with timings.stage("intervals"):
+        vectors = interval_base(corpus, duration_choice, cache)
+    return _unit_rows(vectors, duration_choice, scale_choice, vector_length, minimum_matches, close_distances, timings)
+
+
+def run_sweep(paths, durations, scales, vector_lengths, minimum_matches, close_distances=(), cache_dir=DEFAULT_CACHE_DIR, workers=None, cache=None):
+    """
+    The sweep of every combination of the parameters given, as a DataFrame
+    with SWEEP_COLUMNS.
+
+    workers (int): worker processes, defaults to default_workers(); with 1 the
+        units run one after another in this process, using cache
+    """
+    if workers is None:
+        workers = default_workers()
+    units = _units(durations, scales, vector_lengths)
+    workers = min(workers, len(units))
+    rows = []
+    if workers <= 1:
+        for unit in units:
+            rows += sweep_unit(paths, *unit, minimum_matches, close_distances, cache_dir, cache)
+    else:
+        with process_pool(workers) as executor:
+            futures = [executor.submit(sweep_unit, paths, *unit, minimum_matches, close_distances, cache_dir) for unit in units]
+            for future in futures:
+                rows += future.result()
+    return _sweep_table(rows)
+
+
+def sweep_corpus(corpus, durations, scales, vector_lengths, minimum_matches, close_distances=(), intervals=None, job=None):
+    """
+    Same as run_sweep, over a corpus already loaded and in this thread; its
+    rows have no load_seconds.
+
+    intervals: function returning the IntervalBase of corpus for a duration
+        mode, interval_base(corpus, duration_choice) by default
+    job (jobs.Job): job the sweep runs as, told the units done; once it is
+        stopping, the rows of the units done so far are returned
+    """
+    if intervals is None:
+        intervals = lambda duration_choice: interval_base(corpus, duration_choice)
+    units = _units(durations, scales, vector_lengths)
+    if job is not None:
+        job.progress(0, len(units))
+    rows = []
+    for done, unit in enumerate(units, 1):
+        if job is not None and job.stopping():
+            job.partial = True
+            break
+        timings = RunTimings()
+        with timings.stage("intervals"):
+            vectors = intervals(unit[0])
+        rows += _unit_rows(vectors, *unit, minimum_matches, close_distances, timings)
+        if job is not None:
+            job.progress(done)
+    return _sweep_table(rows)
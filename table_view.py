@@ -0,0 +1,67 @@
+"""
+Server-side paging, sorting and filtering of result tables.
+
+Close searches over many pieces give tens of thousands of rows; sending them
+all to the browser is slower than the search.  The app shows one page of a
+table at a time, and the sorting and filtering that choose that page are done
+here, in pandas.
+"""
+import math
+
+PAGE_SIZES = [25, 100, 500]
+
+
+def filter_rows(df, text, column=None):
+    """
+    Rows of df whose column (or any column, if column is None) contains text,
+    ignoring case, compared as displayed.
+    """
+    if not text:
+        return df
+    columns = df.columns if column is None else [column]
+    found = None
+    for name in columns:
+        contains = df[name].astype(str).str.contains(text, case=False, regex=False)
+        found = contains if found is None else found | contains
+    if found is None:
+        return df
+    return df[found]
+
+
+def sort_rows(df, column, ascending=True):
+    """df sorted by column, stably; columns of values Python cannot compare sort as displayed"""
+    try:
+        return df.sort_values(column, ascending=ascending, kind="stable")
+    except TypeError:
+        return df.sort_values(column, ascending=ascending, kind="stable", key=lambda values: values.astype(str))
+
+
+class TableView:
+    """
+    One page of a table, after filtering and sorting.
+
+    rows (pd.DataFrame): the rows of the page
+    total (int): rows in the table
+    matching (int): rows left by the filter
+    page (int): number of the page shown, from 1, clamped to the pages there are
+    pages (int): number of pages of matching rows
+    first (int): number of the first row shown, from 1, or 0 if none
+    """
+    def __init__(self, df, page=1, page_size=PAGE_SIZES[0], sort_by=None, ascending=True, filter_text="", filter_column=None):
+        self.total = len(df)
+        df = filter_rows(df, filter_text, filter_column)
+        if sort_by is not None:
+            df = sort_rows(df, sort_by, ascending)
+        self.matching = len(df)
+        self.pages = max(1, math.ceil(self.matching / page_size))
+        self.page = min(max(1, page), self.pages)
+        start = (self.page - 1) * page_size
+        self.rows = df.iloc[start:start + page_size]
+        self.first = start + 1 if len(self.rows) else 0
+
+    def summary(self):
+        """e.g. "Rows 101-200 of 1,234 (filtered from 5,678)" """
+        text = "Rows {:,}-{:,} of {:,}".format(self.first, self.first + len(self.rows) - 1, self.matching) if len(self.rows) else "No rows"
+        if self.matching != self.total:
+            text += " (filtered from {:,})".format(self.total)
+        return text
@@ -0,0 +1,83 @@
+"""
+Close searches through the pattern index, and searches filtered down from a
+wider one, give what crim_intervals' own searches give.
+
+Compares find_close_matches_indexed with find_close_matches, and
+filter_matches, filter_results, filter_close_matches and filter_close_results
+of a wide search with fresh searches at the narrower thresholds, over the
+patterns of a piece, as export_pandas tables.
+
+    python -m unittest discover -s tests
+"""
+import sys
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from crim_intervals import export_pandas, find_close_matches, find_exact_matches, into_patterns  # noqa: E402
+
+from close_matches import find_close_matches_indexed  # noqa: E402
+from corpus_loading import load_corpus  # noqa: E402
+from pipeline import filter_close_matches, filter_close_results, filter_matches, filter_results, interval_base, scale_intervals  # noqa: E402
+
+MEI_DIR = Path(__file__).resolve().parent.parent / "mei"
+PIECE = str(MEI_DIR / "CRIM_Model_0026.mei")
+
+
+def table(matches):
+    return pd.DataFrame(export_pandas(matches))
+
+
+def assert_same_results(found, expected):
+    # a search finding nothing has a table without columns, while the table
+    # filtered down to nothing keeps those of the wider search
+    if expected.empty:
+        assert found.empty, found
+    else:
+        pd.testing.assert_frame_equal(found, expected)
+
+
+class CloseMatchesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the notes only hold weak references to their scores, kept by the corpus
+        cls.corpus = load_corpus([PIECE], workers=1)
+        vectors = interval_base(cls.corpus, "Actual")
+        cls.patterns = {(scale_choice, vector_length): into_patterns([scale_intervals(vectors, scale_choice)], vector_length)
+                        for scale_choice in ["Diatonic", "Chromatic"] for vector_length in [3, 5]}
+
+    def test_indexed(self):
+        for (scale_choice, vector_length), patterns in self.patterns.items():
+            for minimum_match, close_distance in [(1, 0), (3, 1), (2, 3)]:
+                with self.subTest(scale=scale_choice, vector_length=vector_length, minimum_match=minimum_match, close_distance=close_distance):
+                    expected = find_close_matches(patterns, minimum_match, close_distance)
+                    found = find_close_matches_indexed(patterns, minimum_match, close_distance)
+                    self.assertEqual([matches.pattern for matches in found], [matches.pattern for matches in expected])
+                    pd.testing.assert_frame_equal(table(found), table(expected))
+
+    def test_filter_exact(self):
+        for (scale_choice, vector_length), patterns in self.patterns.items():
+            wide = find_exact_matches(patterns, 1)
+            for minimum_match in [1, 2, 4, 50]:
+                with self.subTest(scale=scale_choice, vector_length=vector_length, minimum_match=minimum_match):
+                    expected = table(find_exact_matches(patterns, minimum_match))
+                    pd.testing.assert_frame_equal(table(filter_matches(wide, minimum_match)), expected)
+                    assert_same_results(filter_results(table(wide), minimum_match), expected)
+
+    def test_filter_close(self):
+        for (scale_choice, vector_length), patterns in self.patterns.items():
+            wide = find_close_matches_indexed(patterns, 1, 3)
+            for minimum_match, close_distance in [(1, 3), (3, 2), (2, 1), (5, 3), (4, 0), (50, 1)]:
+                with self.subTest(scale=scale_choice, vector_length=vector_length, minimum_match=minimum_match, close_distance=close_distance):
+                    expected = find_close_matches_indexed(patterns, minimum_match, close_distance)
+                    filtered = filter_close_matches(wide, close_distance, minimum_match)
+                    self.assertEqual([matches.pattern for matches in filtered], [matches.pattern for matches in expected])
+                    pd.testing.assert_frame_equal(table(filtered), table(expected))
+                    assert_same_results(filter_close_results(table(wide), close_distance, minimum_match), table(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
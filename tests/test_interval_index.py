@@ -0,0 +1,71 @@
+"""
+The interval index answers exact searches exactly as crim_intervals does.
+
+Indexes two small pieces into a temporary cache, then compares
+IntervalIndex.exact_matches with export_pandas(find_exact_matches(...)) over
+the corpus loaded from the same pieces, in every duration mode and scale, for
+both orders of the pieces (windows spanning the junction of two pieces come
+from the index too).
+
+    python -m unittest discover -s tests
+"""
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from crim_intervals import export_pandas, find_exact_matches, into_patterns  # noqa: E402
+
+from corpus_loading import load_corpus  # noqa: E402
+from interval_index import IntervalIndex, build_index  # noqa: E402
+from pipeline import DURATION_CHOICES, SCALE_CHOICES, interval_base, scale_intervals  # noqa: E402
+
+MEI_DIR = Path(__file__).resolve().parent.parent / "mei"
+PIECES = [str(MEI_DIR / "CRIM_Model_0026.mei"), str(MEI_DIR / "CRIM_Mass_0012_5.mei")]
+
+
+class ExactMatchesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cache_dir = tempfile.TemporaryDirectory()
+        assert build_index(PIECES, cls.cache_dir.name, workers=1) == len(PIECES)
+        cls.index = IntervalIndex(cls.cache_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cache_dir.cleanup()
+
+    def check(self, paths, vector_lengths, minimum_matches):
+        corpus = load_corpus(paths, self.cache_dir.name, workers=1)
+        for duration_choice in DURATION_CHOICES:
+            vectors = interval_base(corpus, duration_choice)
+            for scale_choice in SCALE_CHOICES:
+                for vector_length in vector_lengths:
+                    patterns = into_patterns([scale_intervals(vectors, scale_choice)], vector_length)
+                    for minimum_match in minimum_matches:
+                        with self.subTest(paths=[Path(path).stem for path in paths], duration=duration_choice, scale=scale_choice,
+                                          vector_length=vector_length, minimum_match=minimum_match):
+                            expected = pd.DataFrame(export_pandas(find_exact_matches(patterns, minimum_match)))
+                            found = self.index.exact_matches(paths, duration_choice, scale_choice, vector_length, minimum_match)
+                            self.assertIsNotNone(found)
+                            pd.testing.assert_frame_equal(found, expected)
+
+    def test_one_piece(self):
+        self.check(PIECES[:1], [1, 5, 20], [1, 3])
+
+    def test_two_pieces(self):
+        self.check(PIECES, [4, 6], [2])
+
+    def test_two_pieces_reversed(self):
+        self.check(PIECES[::-1], [5], [3])
+
+    def test_unindexed_piece(self):
+        self.assertIsNone(self.index.exact_matches([str(MEI_DIR / "CRIM_Model_0008.mei")], "Actual", "Diatonic", 5, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+get_ratio_distances gives what the app's original loop over
+itertools.combinations gave.
+
+Compares it, comparing every pair or through the VPTree index and in blocks
+of a few pairs, with that loop over random matches (durations in floats, and
+in the Fractions music21 gives for tuplets) and over the matches of a piece.
+
+    python -m unittest discover -s tests
+"""
+import random
+import sys
+import unittest
+from fractions import Fraction
+from itertools import combinations
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from crim_intervals import export_pandas, find_exact_matches, into_patterns  # noqa: E402
+
+from corpus_loading import load_corpus  # noqa: E402
+from pipeline import interval_base, scale_intervals  # noqa: E402
+from ratio_distances import RaggedArray, compare_ratios, get_ratio_distances, get_ratios  # noqa: E402
+
+MEI_DIR = Path(__file__).resolve().parent.parent / "mei"
+PIECE = str(MEI_DIR / "CRIM_Model_0026.mei")
+OUTPUT_COLS = ["piece_title", "part", "start_measure", "end_measure"]
+
+
+def combinations_ratio_distances(results, pattern_col, output_cols):
+    # the loop get_ratio_distances replaced
+    matches = []
+    for name, group in results.groupby(pattern_col):
+        for a, b in combinations(group.index.values, 2):
+            a_match = results.loc[a]
+            b_match = results.loc[b]
+            match_dict = {"pattern": name, "sum_diffs": compare_ratios(a_match.duration_ratios, b_match.duration_ratios)}
+            for col in output_cols:
+                match_dict.update({f"match_1_{col}": a_match[col], f"match_2_{col}": b_match[col]})
+            matches.append(match_dict)
+    return pd.DataFrame(matches)
+
+
+def random_matches(seed, durations):
+    # a few patterns with many matches each, their durations drawn from durations
+    rng = random.Random(seed)
+    rows = []
+    for pattern in range(12):
+        length = rng.randint(3, 6)
+        generating = tuple(rng.randint(-5, 5) for _ in range(length - 1))
+        for match in range(rng.randint(1, 40)):
+            rows.append({"pattern_generating_match": generating, "piece_title": "Piece " + str(rng.randint(1, 3)),
+                         "part": "Part " + str(rng.randint(1, 4)), "start_measure": rng.randint(1, 80),
+                         "end_measure": rng.randint(1, 80), "note_durations": [rng.choice(durations) for _ in range(length)]})
+    results = pd.DataFrame(rows)
+    results["duration_ratios"] = results["note_durations"].apply(get_ratios)
+    return results
+
+
+class RatioDistancesTest(unittest.TestCase):
+    def check(self, results):
+        expected = combinations_ratio_distances(results, "pattern_generating_match", OUTPUT_COLS)
+        ratios = get_ratios(RaggedArray.from_lists(results["note_durations"]))
+        for block_pairs in [7, 1000]:
+            with self.subTest(block_pairs=block_pairs):
+                found = get_ratio_distances(results, "pattern_generating_match", OUTPUT_COLS, block_pairs=block_pairs)
+                pd.testing.assert_frame_equal(found, expected, check_exact=True)
+                found = get_ratio_distances(results, "pattern_generating_match", OUTPUT_COLS, block_pairs=block_pairs, duration_ratios=ratios)
+                pd.testing.assert_frame_equal(found, expected, check_exact=True)
+            for max_sum_diffs in [0, 1, 2.5]:
+                kept = expected[expected["sum_diffs"] <= max_sum_diffs]
+                for index in [False, True]:
+                    with self.subTest(block_pairs=block_pairs, max_sum_diffs=max_sum_diffs, index=index):
+                        found = get_ratio_distances(results, "pattern_generating_match", OUTPUT_COLS, max_sum_diffs=max_sum_diffs,
+                                                    block_pairs=block_pairs, index=index)
+                        pd.testing.assert_frame_equal(found, kept, check_exact=True, check_index_type=False)
+
+    def test_float_durations(self):
+        self.check(random_matches(1, [0.5, 1.0, 1.5, 2.0, 4.0]))
+
+    def test_fraction_durations(self):
+        self.check(random_matches(2, [Fraction(1, 3), Fraction(2, 3), 1.0, 2.0]))
+
+    def test_piece(self):
+        # the notes only hold weak references to their scores, kept by the corpus
+        corpus = load_corpus([PIECE], workers=1)
+        vectors = interval_base(corpus, "Actual")
+        results = pd.DataFrame(export_pandas(find_exact_matches(into_patterns([scale_intervals(vectors, "Diatonic")], 4), 2)))
+        results["pattern_generating_match"] = results["pattern_generating_match"].apply(tuple)
+        results["duration_ratios"] = results["note_durations"].apply(get_ratios)
+        self.check(results)
+
+
+if __name__ == "__main__":
+    unittest.main()